@@ -1,12 +1,45 @@
+import gc
 import os
+import sys
+import json
 import time
+import zlib
+import base64
+import math
+import bisect
+import heapq
+import pickle
+import operator
+from array import array
+import struct
+import socket
+import hashlib
+import hmac
+import subprocess
 import uuid
 import random
-from datetime import datetime, timedelta
+from collections import deque, OrderedDict
+from datetime import datetime, timedelta, timezone
 
+import eventlet
+from eventlet import tpool
+from eventlet.event import Event
+from eventlet.semaphore import Semaphore
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from flask_socketio import SocketIO, emit, join_room, leave_room
+from flask_socketio import SocketIO, emit
+from socketio import packet as sio_packet
+from engineio import packet as eio_packet
+
+try:
+  import msgpack
+except ImportError:  # binary wire format unavailable, every client gets JSON
+  msgpack = None
+
+try:
+  import numpy
+except ImportError:  # bulk user operations fall back to array/map loops
+  numpy = None
 
 # ---------- BASIC APP SETUP ----------
 
@@ -20,11 +53,528 @@ socketio = SocketIO(
     async_mode="eventlet",
 )
 
+# ---------- RANKED INDEX ----------
+
+RANK_BLOCK = 512  # target keys per block; blocks split at twice this
+
+class RankedIndex:
+  # Order-statistic index over keys (-value, user_id): highest value ranks
+  # first and ties are broken by ascending user_id, so the order is total
+  # and stable across calls. Keys live in sorted blocks of ~RANK_BLOCK with
+  # a Fenwick tree over block lengths, so rank and offset seeks are
+  # O(log n), updates are O(log n + RANK_BLOCK) memmoves, and a bulk load
+  # is a single sort with no per-entry node objects.
+
+  def __init__(self):
+    self.values = {}  # user_id -> value
+    self.blocks = []  # sorted lists of keys
+    self.maxes = []  # last key of each block
+    self.tree = []  # Fenwick tree over len(block)
+
+  def __len__(self):
+    return len(self.values)
+
+  def __contains__(self, user_id):
+    return user_id in self.values
+
+  def get(self, user_id, default=None):
+    return self.values.get(user_id, default)
+
+  def set(self, user_id, value):
+    old = self.values.get(user_id)
+    if old is not None:
+      if old == value:
+        return
+      self._remove((-old, user_id))
+    self.values[user_id] = value
+    self._insert((-value, user_id))
+
+  def discard(self, user_id):
+    old = self.values.pop(user_id, None)
+    if old is not None:
+      self._remove((-old, user_id))
+
+  def rank(self, user_id):
+    value = self.values.get(user_id)
+    if value is None:
+      return None
+    key = (-value, user_id)
+    i = bisect.bisect_left(self.maxes, key)
+    return self._prefix(i) + bisect.bisect_left(self.blocks[i], key) + 1
+
+  def position(self, key):
+    # number of keys that rank at or above key; key need not be present
+    i = bisect.bisect_left(self.maxes, key)
+    if i == len(self.blocks):
+      return len(self.values)
+    return self._prefix(i) + bisect.bisect_right(self.blocks[i], key)
+
+  def slice(self, offset, count):
+    # (user_id, value) pairs for ranks offset+1 .. offset+count
+    if count <= 0 or offset >= len(self.values):
+      return []
+    i, j = self._locate(max(0, offset))
+    out = []
+    blocks = self.blocks
+    while i < len(blocks) and len(out) < count:
+      for key in blocks[i][j:j + count - len(out)]:
+        out.append((key[1], -key[0]))
+      i += 1
+      j = 0
+    return out
+
+  def load(self, items):
+    # Bulk rebuild from (user_id, value) pairs.
+    self.values = dict(items)
+    keys = sorted([(-value, user_id) for user_id, value in self.values.items()])
+    self.blocks = [keys[i:i + RANK_BLOCK] for i in range(0, len(keys), RANK_BLOCK)]
+    self.maxes = [block[-1] for block in self.blocks]
+    self._rebuild_tree()
+
+  def load_blocks(self, columns):
+    # Rebuild from already-ranked (user_ids, values) column pairs, e.g. a
+    # snapshot copy, without re-sorting.
+    self.values = {}
+    self.blocks = []
+    for user_ids, values in columns:
+      if len(user_ids):
+        self.values.update(zip(user_ids, values))
+        self.blocks.append(list(zip(map(operator.neg, values), user_ids)))
+    self.maxes = [block[-1] for block in self.blocks]
+    self._rebuild_tree()
+
+  def copy_blocks(self):
+    return [list(block) for block in self.blocks]
+
+  def _insert(self, key):
+    blocks = self.blocks
+    if not blocks:
+      blocks.append([key])
+      self.maxes.append(key)
+      self._rebuild_tree()
+      return
+    i = bisect.bisect_left(self.maxes, key)
+    if i == len(blocks):
+      i -= 1
+    block = blocks[i]
+    bisect.insort(block, key)
+    self.maxes[i] = block[-1]
+    if len(block) > 2 * RANK_BLOCK:
+      blocks.insert(i + 1, block[RANK_BLOCK:])
+      del block[RANK_BLOCK:]
+      self.maxes[i] = block[-1]
+      self.maxes.insert(i + 1, blocks[i + 1][-1])
+      self._rebuild_tree()
+    else:
+      self._add(i, 1)
+
+  def _remove(self, key):
+    i = bisect.bisect_left(self.maxes, key)
+    if i == len(self.blocks):
+      return
+    block = self.blocks[i]
+    j = bisect.bisect_left(block, key)
+    if j == len(block) or block[j] != key:
+      return
+    del block[j]
+    if block:
+      self.maxes[i] = block[-1]
+      self._add(i, -1)
+    else:
+      del self.blocks[i]
+      del self.maxes[i]
+      self._rebuild_tree()
+
+  def _rebuild_tree(self):
+    tree = [len(block) for block in self.blocks]
+    for i in range(len(tree)):
+      parent = i | (i + 1)
+      if parent < len(tree):
+        tree[parent] += tree[i]
+    self.tree = tree
+
+  def _add(self, i, delta):
+    tree = self.tree
+    while i < len(tree):
+      tree[i] += delta
+      i |= i + 1
+
+  def _prefix(self, i):
+    # total keys in blocks[:i]
+    total = 0
+    tree = self.tree
+    while i > 0:
+      total += tree[i - 1]
+      i &= i - 1
+    return total
+
+  def _locate(self, offset):
+    # (block, position) of the key at 0-based offset
+    tree = self.tree
+    i = 0
+    step = 1 << len(tree).bit_length()
+    while step:
+      nxt = i + step
+      if nxt <= len(tree) and tree[nxt - 1] <= offset:
+        i = nxt
+        offset -= tree[nxt - 1]
+      step >>= 1
+    return i, offset
+
+# ---------- MATCHMAKING QUEUES ----------
+
+MM_BUCKET_WIDTH = 50  # rating points per bucket
+MM_BASE_WINDOW = 50  # rating window for a fresh ticket
+MM_WIDEN_PER_SEC = 10  # window growth per second waited
+MM_MAX_WINDOW = 1000
+MM_SWEEP_INTERVAL = float(os.environ.get("MM_SWEEP_INTERVAL", 1.0))  # seconds between matching passes
+MM_FILL_WAIT = 10  # seconds a ticket waits for a full group before accepting min_size
+MM_SWEEP_ANCHORS = 1000  # anchors looked at per matching pass (~6-10us each)
+MM_SWEEP_GROUPS = 40  # matches started per matching pass (~0.25ms each)
+
+class MatchQueue:
+  # Tickets live in a wait-ordered dict plus a per-rating-bucket dict, so
+  # enqueue/dequeue are O(1) dict operations plus an O(log b) bisect over
+  # the non-empty bucket ids.
+
+  def __init__(self, mode, size, min_size=None):
+    self.mode = mode
+    self.size = size
+    self.min_size = min_size or size  # smaller groups form once the anchor waited MM_FILL_WAIT
+    self.tickets = {}  # sid -> ticket, oldest first
+    self.buckets = {}  # bucket id -> {sid -> ticket}, oldest first
+    self.bucket_ids = []  # sorted non-empty bucket ids
+    self.waits = deque(maxlen=1000)  # seconds waited by recently matched tickets
+    self.matches_formed = 0
+    self.seq = 0  # enqueue counter, so tickets are ordered by seq
+    self.cursor = 0  # seq of the last anchor a partial sweep looked at, 0 when done
+
+  def __len__(self):
+    return len(self.tickets)
+
+  def __contains__(self, sid):
+    return sid in self.tickets
+
+  def add(self, user, sid, rating, now):
+    if sid in self.tickets:
+      return
+    b = int(rating // MM_BUCKET_WIDTH)
+    self.seq += 1
+    ticket = {"sid": sid, "user": user, "rating": rating, "bucket": b, "enqueued_at": now, "seq": self.seq}
+    self.tickets[sid] = ticket
+    bucket = self.buckets.get(b)
+    if bucket is None:
+      bucket = self.buckets[b] = {}
+      bisect.insort(self.bucket_ids, b)
+    bucket[sid] = ticket
+
+  def remove(self, sid):
+    ticket = self.tickets.pop(sid, None)
+    if ticket is None:
+      return None
+    b = ticket["bucket"]
+    bucket = self.buckets[b]
+    del bucket[sid]
+    if not bucket:
+      del self.buckets[b]
+      del self.bucket_ids[bisect.bisect_left(self.bucket_ids, b)]
+    return ticket
+
+  def window(self, ticket, now):
+    return min(MM_MAX_WINDOW, MM_BASE_WINDOW + MM_WIDEN_PER_SEC * (now - ticket["enqueued_at"]))
+
+  def find_group(self, anchor, now):
+    rating = anchor["rating"]
+    window = self.window(anchor, now)
+    lo = bisect.bisect_left(self.bucket_ids, int((rating - window) // MM_BUCKET_WIDTH))
+    hi = bisect.bisect_right(self.bucket_ids, int((rating + window) // MM_BUCKET_WIDTH))
+    nearby = sorted(self.bucket_ids[lo:hi], key=lambda b: abs(b - anchor["bucket"]))
+    group = [anchor]
+    for b in nearby:
+      for ticket in self.buckets[b].values():
+        if ticket is anchor or abs(ticket["rating"] - rating) > window:
+          continue
+        group.append(ticket)
+        if len(group) == self.size:
+          return group
+    if len(group) >= self.min_size and now - anchor["enqueued_at"] >= MM_FILL_WAIT:
+      return group
+    return None
+
+  def sweep(self, now):
+    # Oldest tickets anchor first since they have the widest window. One
+    # call is a bounded slice of a pass over the queue: it stops after
+    # MM_SWEEP_ANCHORS anchors or MM_SWEEP_GROUPS groups and leaves
+    # self.cursor where the next call resumes (0 once the pass is done).
+    groups = []
+    if len(self.tickets) < self.min_size:
+      self.cursor = 0
+      return groups
+    anchors = []
+    for ticket in self.tickets.values():
+      if ticket["seq"] > self.cursor:
+        anchors.append(ticket)
+        if len(anchors) == MM_SWEEP_ANCHORS:
+          break
+    self.cursor = anchors[-1]["seq"] if len(anchors) == MM_SWEEP_ANCHORS else 0
+    for anchor in anchors:
+      if self.tickets.get(anchor["sid"]) is not anchor:
+        continue
+      group = self.find_group(anchor, now)
+      if group is None:
+        continue
+      for ticket in group:
+        self.remove(ticket["sid"])
+        self.waits.append(now - ticket["enqueued_at"])
+      self.matches_formed += 1
+      groups.append(group)
+      if len(self.tickets) < self.min_size:
+        self.cursor = 0
+        break
+      if len(groups) == MM_SWEEP_GROUPS:
+        self.cursor = anchor["seq"]
+        break
+    return groups
+
+  def stats(self, now):
+    waits = sorted(self.waits)
+    oldest = next(iter(self.tickets.values()), None)
+    return {
+      "mode": self.mode,
+      "depth": len(self.tickets),
+      "buckets": len(self.bucket_ids),
+      "matches_formed": self.matches_formed,
+      "oldest_wait": round(now - oldest["enqueued_at"], 3) if oldest else 0,
+      "wait_p50": round(waits[len(waits) // 2], 3) if waits else 0,
+      "wait_p95": round(waits[int(len(waits) * 0.95)], 3) if waits else 0,
+    }
+
+# ---------- USER STORE ----------
+
+# Users are rows in columns: typed arrays for counters and flags, lists
+# for strings, and 64-bit masks for owned characters and shop items (so at
+# most 64 of each, bits assigned in USER_MASK_BITS). USERS.get() returns a UserView, a two-slot
+# dict-like window onto one row, so handlers keep writing user["coins"] -= x.
+# Rows are append-only, so a row number is a stable user index.
+# Operations that touch every user run over whole columns: through numpy
+# when it is installed, otherwise through array/map, which still loops in C.
+
+USER_INT_FIELDS = [
+    "coins", "gems", "star_points", "wins", "damage", "kos", "event_xp", "bp_level", "bp_xp",
+    "admin_events_created", "admin_events_triggered", "version",
+]
+USER_FLAG_FIELDS = ["is_first_bogacactus"]
+USER_STR_FIELDS = ["id", "username", "password", "selected_character_id"]
+USER_MASK_FIELDS = ["owned_characters", "owned_items"]
+USER_DEFAULTS = {"bp_level": 1, "version": 1, "selected_character_id": "fighter_1"}
+
+class OwnedSet:
+  # Set-like view of one user's bitmask over the ids in bits.
+  __slots__ = ("masks", "row", "bits")
+
+  def __init__(self, masks, row, bits):
+    self.masks = masks
+    self.row = row
+    self.bits = bits
+
+  def __contains__(self, key):
+    bit = self.bits.get(key)
+    return bool(bit and self.masks[self.row] & bit)
+
+  def __iter__(self):
+    mask = self.masks[self.row]
+    return (key for key, bit in self.bits.items() if mask & bit)
+
+  def __len__(self):
+    return bin(self.masks[self.row]).count("1")
+
+  def add(self, key):
+    self.masks[self.row] |= self.bits[key]
+
+class UserView:
+  __slots__ = ("store", "row")
+
+  def __init__(self, store, row):
+    self.store = store
+    self.row = row
+
+  def __getitem__(self, key):
+    return self.store.get_field(self.row, key)
+
+  def __setitem__(self, key, value):
+    self.store.set_field(self.row, key, value)
+
+  def __eq__(self, other):
+    return isinstance(other, UserView) and other.store is self.store and other.row == self.row
+
+  def __hash__(self):
+    return self.row
+
+  def get(self, key, default=None):
+    if key in self.store.fields:
+      return self.store.get_field(self.row, key)
+    return default
+
+  def update(self, values):
+    for key, value in values.items():
+      self.store.set_field(self.row, key, value)
+
+  def to_dict(self):
+    return {key: self.store.export_field(self.row, key) for key in self.store.fields}
+
+class UserStore:
+  def __init__(self):
+    self.index = {}  # user id -> row
+    self.ints = {f: array("q") for f in USER_INT_FIELDS}
+    self.flags = {f: array("b") for f in USER_FLAG_FIELDS}
+    self.strs = {f: [] for f in USER_STR_FIELDS}
+    self.masks = {f: array("Q") for f in USER_MASK_FIELDS}
+    self.fields = {f: ("mask", c) for f, c in self.masks.items()}  # field -> (kind, column)
+    self.fields.update((f, ("int", c)) for f, c in self.ints.items())
+    self.fields.update((f, ("flag", c)) for f, c in self.flags.items())
+    self.fields.update((f, ("str", c)) for f, c in self.strs.items())
+
+  def __len__(self):
+    return len(self.index)
+
+  def __contains__(self, user_id):
+    return user_id in self.index
+
+  def __getitem__(self, user_id):
+    return UserView(self, self.index[user_id])
+
+  def __setitem__(self, user_id, user):
+    self.add(dict(user, id=user_id))
+
+  def get(self, user_id, default=None):
+    row = self.index.get(user_id)
+    return default if row is None else UserView(self, row)
+
+  def values(self):
+    return (UserView(self, row) for row in range(len(self.index)))
+
+  def clear(self):
+    self.index.clear()
+    for column in self.ints.values():
+      del column[:]
+    for column in self.flags.values():
+      del column[:]
+    for column in self.strs.values():
+      del column[:]
+    for column in self.masks.values():
+      del column[:]
+
+  def add(self, user):
+    # Insert a user dict, or overwrite the row if the id already exists.
+    row = self.index.get(user["id"])
+    if row is not None:
+      view = UserView(self, row)
+      view.update({k: v for k, v in user.items() if k in self.fields})
+      return view
+    row = len(self.index)
+    self.index[user["id"]] = row
+    get = user.get
+    for f, column in self.ints.items():
+      column.append(get(f, USER_DEFAULTS.get(f, 0)))
+    for f, column in self.flags.items():
+      column.append(1 if get(f) else 0)
+    for f, column in self.strs.items():
+      column.append(get(f, USER_DEFAULTS.get(f)))
+    for f, column in self.masks.items():
+      column.append(bitmask(USER_MASK_BITS[f], get(f, ())))
+    return UserView(self, row)
+
+  def get_field(self, row, key):
+    kind, column = self.fields[key]
+    if kind == "flag":
+      return bool(column[row])
+    if kind == "mask":
+      return OwnedSet(column, row, USER_MASK_BITS[key])
+    return column[row]
+
+  def set_field(self, row, key, value):
+    kind, column = self.fields[key]
+    if kind == "mask":
+      if not isinstance(value, int):
+        value = bitmask(USER_MASK_BITS[key], value)
+    elif kind == "flag":
+      value = 1 if value else 0
+    column[row] = value
+
+  def export_field(self, row, key):
+    value = self.get_field(row, key)
+    return set(value) if isinstance(value, OwnedSet) else value
+
+  def has_flag(self, field):
+    return 1 in self.flags[field]
+
+  # --- whole-column operations
+
+  def add_to_all(self, field, amount):
+    column = self.ints[field]
+    if numpy is not None:
+      view = numpy.frombuffer(column, dtype=numpy.int64)
+      view += amount
+      del view  # release the buffer so the array can grow again
+    else:
+      column[:] = array("q", map(amount.__add__, column))
+
+  def fill(self, field, value):
+    column = self.ints[field]
+    column[:] = array("q", [value]) * len(column)
+
+  def percentiles(self, field, qs):
+    # Nearest-rank percentiles of one column.
+    column = self.ints[field]
+    if not column:
+      return [0 for _ in qs]
+    n = len(column)
+    ranks = [min(n - 1, max(0, math.ceil(q / 100 * n) - 1)) for q in qs]
+    if numpy is not None:
+      values = numpy.partition(numpy.frombuffer(column, dtype=numpy.int64), ranks)
+      return [int(values[r]) for r in ranks]
+    values = sorted(column)
+    return [values[r] for r in ranks]
+
+  # --- snapshots
+
+  def copy_columns(self):
+    columns = {f: c[:] for f, c in self.ints.items()}
+    columns.update((f, c[:]) for f, c in self.flags.items())
+    columns.update((f, c[:]) for f, c in self.strs.items())
+    columns.update((f, c[:]) for f, c in self.masks.items())
+    return columns
+
+  def load_columns(self, columns):
+    start = len(self.index)
+    ids = columns["id"]
+    self.index.update(zip(ids, range(start, start + len(ids))))
+    for f, column in self.ints.items():
+      column.extend(columns[f])
+    for f, column in self.flags.items():
+      column.extend(columns[f])
+    for f, column in self.strs.items():
+      column.extend(columns[f])
+    for f, column in self.masks.items():
+      column.extend(columns[f] if f in columns else array("Q", bytes(8 * len(ids))))
+
+def bitmask(bits, keys):
+  mask = 0
+  for key in keys:
+    mask |= bits[key]
+  return mask
+
 # ---------- IN-MEMORY DATA (DEV ONLY) ----------
 
-USERS = {}  # user_id -> user dict
+USERS = UserStore()  # user_id -> UserView
 USERNAME_INDEX = {}  # username -> user_id
-TOKENS = {}  # token -> user_id
+TOKENS = OrderedDict()  # token -> session dict, least recently used first
+USER_SESSIONS = {}  # user_id -> OrderedDict of that user's tokens, least recently used first
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 7 * 24 * 3600))  # sliding, in seconds
+SESSION_MAX_PER_USER = 5
+SESSION_MAX_TOTAL = int(os.environ.get("SESSION_MAX_TOTAL", 500000))
+SESSION_SWEEP_INTERVAL = 60
+SESSION_SWEEPER = {"task": None}
 
 CHARACTER_TEMPLATES = [
     {"id": "fighter_1", "name": "Blaze", "rarity": "Common", "hp": 100, "damage": 10, "speed": 5, "cost_coins": 0},
@@ -39,6 +589,10 @@ SHOP_ITEMS = [
     {"id": "shop_trail_1", "name": "Teal Magenta Trail", "type": "trail", "rarity": "Legendary", "cost_amount": 2000, "cost_currency": "coins"},
 ]
 
+CHARACTER_BITS = {tmpl["id"]: 1 << i for i, tmpl in enumerate(CHARACTER_TEMPLATES)}
+SHOP_ITEM_BITS = {item["id"]: 1 << i for i, item in enumerate(SHOP_ITEMS)}
+USER_MASK_BITS = {"owned_characters": CHARACTER_BITS, "owned_items": SHOP_ITEM_BITS}  # append-only: bits are stored
+
 MAP_TEMPLATES = [
     {"name": "Sky Platforms", "style": "Floating islands", "tagline": "Stick Fight–style floating chaos"},
     {"name": "Central Tower", "style": "Vertical climb", "tagline": "Fight up and down the tower"},
@@ -76,18 +630,55 @@ EVENTS = [
 CURRENT_EVENT_INDEX = 0
 CURRENT_EVENT = None
 
-LEADERBOARDS = {
-    "wins": {},
-    "damage": {},
-    "kos": {},
-    "event_xp": {},
-    "bp": {},
-    "admin": {},
+LEADERBOARD_STATS = ["wins", "damage", "kos", "event_xp", "bp", "admin"]
+LEADERBOARDS = {stat: RankedIndex() for stat in LEADERBOARD_STATS}  # stat -> RankedIndex
+LEADERBOARD_SOURCES = {  # stat -> user field it ranks
+    "wins": "wins",
+    "damage": "damage",
+    "kos": "kos",
+    "event_xp": "event_xp",
+    "bp": "bp_level",
+    "admin": "admin_events_triggered",
 }
+LEADERBOARD_PAGE_DEFAULT = 75
+LEADERBOARD_PAGE_MAX = 100  # entries per page, larger limits are clamped
+LEADERBOARD_AROUND_DEFAULT = 5
+LEADERBOARD_AROUND_MAX = 25  # entries either side of the caller
+# Serialized first pages: stat -> {limit: (cutoff key or None, more, body)}.
+# The cutoff is the key of the page's last entry; a full page only goes
+# stale when an update moves a key to or from a rank at or above it, or
+# when a new entry gives a page that had no next_cursor one.
+LEADERBOARD_PAGES = {stat: {} for stat in LEADERBOARD_STATS}
 
 MATCHES = {}  # room_id -> match_state
-QUEUE_1V1 = []
-QUEUE_2V2 = []
+KEYFRAME_INTERVAL = int(os.environ.get("KEYFRAME_INTERVAL", 50))  # updates between full keyframes
+TICK_RATE = int(os.environ.get("TICK_RATE", 20))  # match simulation ticks per second
+MAX_PENDING_INPUTS = 64  # per match, inputs beyond this are dropped until the next tick
+PENDING_ROOMS = set()  # room_ids with queued inputs for the next tick
+TICK_LOOP = {"task": None, "tick": 0}
+MATCH_GC_INTERVAL = 10  # seconds between match garbage collection sweeps
+MATCH_GC_GRACE = int(os.environ.get("MATCH_GC_GRACE", 60))  # seconds a finished/abandoned match is kept
+MATCH_IDLE_TIMEOUT = 15 * 60  # seconds without input before a running match is considered abandoned
+
+GRID_CELL = 0.1  # side of a spatial grid cell, in screen units
+PLAYER_HITBOX = 0.04  # hitbox radius
+ATTACK_RANGES = {"LIGHT_ATTACK": 0.12, "HEAVY_ATTACK": 0.18, "ECLIPSE": 0.35}
+MOVE_QUANT = 65535  # MOVE coordinates are quantized to this many steps per axis
+MOVE_STEP = 0.01  # max distance covered by one MOVE per point of speed
+FFA_SPAWN_RADIUS = 0.35
+
+SID_ROOM = {}  # sid -> room_id of the match the sid is playing in
+SID_USER = {}  # sid -> user_id
+MATCH_QUEUES = {
+    "1v1": MatchQueue("1v1", 2),
+    "2v2": MatchQueue("2v2", 4),
+    "ffa": MatchQueue("ffa", 16, 8),
+}
+MATCHMAKING_LOOP = {"task": None}
+
+CATALOG = {"version": 0}  # see rebuild_catalog
+BOOT_ID = uuid.uuid4().hex[:8]  # user versions restart from the persisted state, so ETags carry this
+ME_SECTIONS = ["user", "event", "characters", "battlepass", "shop", "maps"]
 
 ADMIN_EVENTS = []
 SCHEDULED_EVENTS = []
@@ -100,12 +691,21 @@ def generate_token():
 def now_ts():
   return int(time.time())
 
+def parse_count_arg(name, default, lo, hi):
+  # Query-string count clamped to [lo, hi]; None if it isn't an integer.
+  raw = request.args.get(name)
+  if raw is None:
+    return default
+  try:
+    return min(hi, max(lo, int(raw)))
+  except ValueError:
+    return None
+
 def get_current_event():
   global CURRENT_EVENT, CURRENT_EVENT_INDEX
   if CURRENT_EVENT is None:
-    CURRENT_EVENT_INDEX = 0
-    base = EVENTS[CURRENT_EVENT_INDEX]
-    CURRENT_EVENT = build_event_palette(base)
+    CURRENT_EVENT_INDEX = rotation_index(time.time())
+    CURRENT_EVENT = EVENT_PALETTES[CURRENT_EVENT_INDEX]
   return CURRENT_EVENT
 
 def build_event_palette(base):
@@ -133,12 +733,71 @@ def build_event_palette(base):
     "palette": palette,
   }
 
-def get_user_from_token():
+def create_session(user_id):
+  token = generate_token()
+  TOKENS[token] = {"user_id": user_id, "expires_at": time.monotonic() + SESSION_TTL}
+  user_tokens = USER_SESSIONS.setdefault(user_id, OrderedDict())
+  user_tokens[token] = True
+  while len(user_tokens) > SESSION_MAX_PER_USER:
+    drop_session(next(iter(user_tokens)))
+  while len(TOKENS) > SESSION_MAX_TOTAL:
+    drop_session(next(iter(TOKENS)))
+  ensure_session_sweeper()
+  return token
+
+def drop_session(token):
+  session = TOKENS.pop(token, None)
+  if session is None:
+    return
+  user_tokens = USER_SESSIONS.get(session["user_id"])
+  if user_tokens is not None:
+    user_tokens.pop(token, None)
+    if not user_tokens:
+      del USER_SESSIONS[session["user_id"]]
+
+def lookup_session(token):
+  session = TOKENS.get(token)
+  if session is None:
+    return None
+  now = time.monotonic()
+  if session["expires_at"] <= now:
+    drop_session(token)
+    return None
+  session["expires_at"] = now + SESSION_TTL
+  TOKENS.move_to_end(token)
+  USER_SESSIONS[session["user_id"]].move_to_end(token)
+  return session["user_id"]
+
+def sweep_sessions():
+  # Expiry slides with use and TOKENS is in use order, so every expired
+  # session sits at the front.
+  now = time.monotonic()
+  while TOKENS:
+    token, session = next(iter(TOKENS.items()))
+    if session["expires_at"] > now:
+      break
+    drop_session(token)
+
+def session_sweeper_loop():
+  while True:
+    socketio.sleep(SESSION_SWEEP_INTERVAL)
+    sweep_sessions()
+
+def ensure_session_sweeper():
+  if SESSION_SWEEPER["task"] is None:
+    SESSION_SWEEPER["task"] = socketio.start_background_task(session_sweeper_loop)
+
+def get_request_token():
   auth = request.headers.get("Authorization", "")
   if not auth.startswith("Bearer "):
     return None
-  token = auth.split(" ", 1)[1]
-  user_id = TOKENS.get(token)
+  return auth.split(" ", 1)[1]
+
+def get_user_from_token(token=None):
+  token = token or get_request_token()
+  if not token:
+    return None
+  user_id = lookup_session(token)
   if not user_id:
     return None
   return USERS.get(user_id)
@@ -146,11 +805,13 @@ def get_user_from_token():
 def ensure_bogacactus_first(user):
   if user["username"] != "Bogacactus":
     return
-  existing_admin = any(u.get("is_first_bogacactus") for u in USERS.values())
-  if not existing_admin:
-    user["is_first_bogacactus"] = True
-  else:
-    user["is_first_bogacactus"] = False
+  existing_admin = USERS.has_flag("is_first_bogacactus")
+  is_first = not existing_admin
+  if user.get("is_first_bogacactus") != is_first:
+    user["is_first_bogacactus"] = is_first
+    touch_user(user)
+    return True
+  return False
 
 def serialize_user(user):
   return {
@@ -161,6 +822,7 @@ def serialize_user(user):
     "star_points": user["star_points"],
     "selected_character_id": user.get("selected_character_id"),
     "is_first_bogacactus": user.get("is_first_bogacactus", False),
+    "owned_items": list(user["owned_items"]),
   }
 
 def build_user_characters(user):
@@ -190,41 +852,773 @@ def build_battlepass(user):
     ],
   }
 
-def build_shop(user):
-  return SHOP_ITEMS
-
-def build_maps():
-  return MAP_TEMPLATES
+def serialize_json(obj):
+  return json.dumps(obj, separators=(",", ":"))
+
+def touch_user(user):
+  user["version"] += 1
+
+def rebuild_catalog():
+  # Global /me sections, serialized once per catalog version.
+  CATALOG["version"] += 1
+  CATALOG["event"] = serialize_json(get_current_event())
+  CATALOG["shop"] = serialize_json(SHOP_ITEMS)
+  CATALOG["maps"] = serialize_json(MAP_TEMPLATES)
+  CATALOG["characters"] = [
+    (tmpl["id"], serialize_json(dict(tmpl, owned=True)), serialize_json(dict(tmpl, owned=False)))
+    for tmpl in CHARACTER_TEMPLATES
+  ]
+
+def get_catalog():
+  if not CATALOG["version"]:
+    rebuild_catalog()
+  return CATALOG
+
+def render_user_characters(user, catalog):
+  owned_ids = user["owned_characters"]
+  return "[" + ",".join(
+    owned if cid in owned_ids else unowned
+    for cid, owned, unowned in catalog["characters"]
+  ) + "]"
+
+def render_me_section(name, user, catalog):
+  if name == "user":
+    return serialize_json(serialize_user(user))
+  if name == "characters":
+    return render_user_characters(user, catalog)
+  if name == "battlepass":
+    return serialize_json(build_battlepass(user))
+  return catalog[name]
 
 def update_leaderboard(stat, user_id, value):
-  LEADERBOARDS[stat][user_id] = value
+  board = LEADERBOARDS[stat]
+  old = board.get(user_id)
+  if old == value:
+    return
+  board.set(user_id, value)
+  pages = LEADERBOARD_PAGES[stat]
+  if pages:
+    new_key = (-value, user_id)
+    old_key = None if old is None else (-old, user_id)
+    for limit, (cutoff, more, _) in list(pages.items()):
+      if cutoff is None or new_key <= cutoff:
+        del pages[limit]
+      elif old_key is not None and old_key <= cutoff:
+        del pages[limit]
+      elif old_key is None and not more:
+        del pages[limit]  # a new entry below the page now follows it
+
+def clear_leaderboard_pages(stat=None):
+  for s in LEADERBOARD_PAGES if stat is None else [stat]:
+    LEADERBOARD_PAGES[s].clear()
+
+def sync_user_leaderboards(user, fields=None):
+  for stat, field in LEADERBOARD_SOURCES.items():
+    if fields is not None and field not in fields and not (stat == "admin" and "is_first_bogacactus" in fields):
+      continue
+    if stat == "admin" and not user.get("is_first_bogacactus"):
+      continue
+    update_leaderboard(stat, user["id"], user[field])
 
-def get_leaderboard_entries(stat, limit=75):
+def build_leaderboard_entries(pairs, first_rank):
   entries = []
-  for user_id, value in LEADERBOARDS[stat].items():
+  for rank, (user_id, value) in enumerate(pairs, first_rank):
     user = USERS.get(user_id)
     if not user:
       continue
     entries.append({
+      "rank": rank,
       "user_id": user_id,
       "username": user["username"],
       "value": value,
       "value_label": value,
     })
-  entries.sort(key=lambda e: e["value"], reverse=True)
-  return entries[:limit]
+  return entries
+
+def get_leaderboard_entries(stat, limit=75, offset=0):
+  return build_leaderboard_entries(LEADERBOARDS[stat].slice(offset, limit), offset + 1)
+
+def encode_leaderboard_cursor(user_id, value):
+  return base64.urlsafe_b64encode(f"{value}:{user_id}".encode()).decode().rstrip("=")
+
+def decode_leaderboard_cursor(cursor):
+  # -> the board key the next page starts after, or None if malformed
+  try:
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    value, user_id = raw.split(":", 1)
+    return (-int(value), user_id)
+  except ValueError:
+    return None
+
+def get_leaderboard_page(board, limit, after=None):
+  # Keyset pagination: a cursor names the last key served, so concurrent
+  # rank changes never repeat or skip entries that kept their value.
+  offset = 0 if after is None else board.position(after)
+  pairs = board.slice(offset, limit)
+  more = pairs and offset + len(pairs) < len(board)
+  return {
+    "entries": build_leaderboard_entries(pairs, offset + 1),
+    "next_cursor": encode_leaderboard_cursor(*pairs[-1]) if more else None,
+  }
+
+def get_top_page_body(stat, limit):
+  pages = LEADERBOARD_PAGES[stat]
+  cached = pages.get(limit)
+  if cached is not None:
+    return cached[2]
+  board = LEADERBOARDS[stat]
+  page = get_leaderboard_page(board, limit)
+  body = serialize_json(page)
+  cutoff = None
+  if len(board) >= limit:
+    user_id, value = board.slice(limit - 1, 1)[0]
+    cutoff = (-value, user_id)
+  pages[limit] = (cutoff, page["next_cursor"] is not None, body)
+  return body
 
 def get_rank(stat, user_id):
-  entries = get_leaderboard_entries(stat, limit=100000)
-  for idx, e in enumerate(entries):
-    if e["user_id"] == user_id:
-      return idx + 1, e["value"]
-  return None, 0
+  board = LEADERBOARDS[stat]
+  rank = board.rank(user_id)
+  if rank is None:
+    return None, 0
+  return rank, board.get(user_id)
+
+# ---------- RATE LIMITING ----------
+
+# Token buckets: [tokens, last_refill]. Match input is limited per sid with
+# a cost per action plus a per-action cooldown, and checked in the socket
+# handler, before the input reaches a match queue or the shard bus. Auth
+# routes are limited per client address.
+
+ACTION_COSTS = {
+    "LIGHT_ATTACK": 1,
+    "HEAVY_ATTACK": 2,
+    "BLOCK": 1,
+    "ABILITY": 3,
+    "ECLIPSE": 5,
+    "MOVE": 0.25,
+}
+ACTION_COOLDOWNS = {  # seconds between two uses of the same action
+    "LIGHT_ATTACK": 0.1,
+    "HEAVY_ATTACK": 0.4,
+    "BLOCK": 0.1,
+    "ABILITY": 1.0,
+    "ECLIPSE": 3.0,
+    "MOVE": 0.04,
+}
+ACTION_RATE = float(os.environ.get("ACTION_RATE", "12"))  # tokens per second per sid
+ACTION_BURST = float(os.environ.get("ACTION_BURST", "20"))
+
+HTTP_LIMITS = {  # name -> (tokens per second, burst) per client address
+    "login": (1.0, 10),
+    "signup": (0.2, 5),
+}
+HTTP_BUCKETS_MAX = 100000
+
+SID_LIMITS = {}  # sid -> [tokens, last_refill, {action: ready_at}]
+HTTP_BUCKETS = OrderedDict()  # (name, addr) -> [tokens, last_refill], LRU order
+INPUT_DROPS = {"invalid": 0, "rate": 0, "cooldown": 0}
+HTTP_DROPS = {name: 0 for name in HTTP_LIMITS}
+
+def take_tokens(bucket, cost, rate, burst, now):
+  tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+  bucket[1] = now
+  if tokens < cost:
+    bucket[0] = tokens
+    return False
+  bucket[0] = tokens - cost
+  return True
+
+def allow_action(sid, action):
+  cost = ACTION_COSTS.get(action)
+  if cost is None:
+    INPUT_DROPS["invalid"] += 1
+    return False
+  now = time.monotonic()
+  limits = SID_LIMITS.get(sid)
+  if limits is None:
+    limits = SID_LIMITS[sid] = [ACTION_BURST, now, {}]
+  ready = limits[2]
+  if ready.get(action, 0) > now:
+    INPUT_DROPS["cooldown"] += 1
+    return False
+  if not take_tokens(limits, cost, ACTION_RATE, ACTION_BURST, now):
+    INPUT_DROPS["rate"] += 1
+    return False
+  ready[action] = now + ACTION_COOLDOWNS[action]
+  return True
+
+def allow_request(name):
+  rate, burst = HTTP_LIMITS[name]
+  key = (name, request.remote_addr)
+  now = time.monotonic()
+  bucket = HTTP_BUCKETS.get(key)
+  if bucket is None:
+    bucket = HTTP_BUCKETS[key] = [burst, now]
+    while len(HTTP_BUCKETS) > HTTP_BUCKETS_MAX:
+      HTTP_BUCKETS.popitem(last=False)
+  else:
+    HTTP_BUCKETS.move_to_end(key)
+  if take_tokens(bucket, 1, rate, burst, now):
+    return True
+  HTTP_DROPS[name] += 1
+  return False
+
+def too_many_requests(name):
+  rate, _ = HTTP_LIMITS[name]
+  return "Too many requests", 429, {"Retry-After": str(max(1, int(1 / rate)))}
+
+# ---------- WORKER POOL ----------
+
+# CPU-heavy work (password hashing, replay encoding) runs on eventlet's
+# native thread pool so the hub keeps ticking matches meanwhile. Work in
+# C that drops the GIL, like hashlib's KDFs, runs truly in parallel.
+# Request paths shed load: once CPU_POOL_QUEUE jobs are waiting or
+# running, run_in_pool raises PoolBusy and the route answers 503 instead
+# of queueing without bound. Background work passes shed=False and waits.
+
+CPU_POOL_THREADS = int(os.environ.get("CPU_POOL_THREADS", 4))
+CPU_POOL_QUEUE = int(os.environ.get("CPU_POOL_QUEUE", 64))  # jobs waiting or running before requests get 503
+CPU_POOL = {
+    "inflight": 0,
+    "completed": 0,
+    "rejected": 0,
+}
+tpool.set_num_threads(CPU_POOL_THREADS)
+
+class PoolBusy(Exception):
+  pass
+
+def run_in_pool(fn, *args, shed=True):
+  pool = CPU_POOL
+  if shed and pool["inflight"] >= CPU_POOL_QUEUE:
+    pool["rejected"] += 1
+    raise PoolBusy()
+  pool["inflight"] += 1
+  try:
+    return tpool.execute(fn, *args)
+  finally:
+    pool["inflight"] -= 1
+    pool["completed"] += 1
+
+def pool_busy():
+  return "Server busy, try again shortly", 503, {"Retry-After": "1"}
+
+# ---------- PASSWORDS ----------
+
+# Stored as "scrypt$n$r$p$salt$hash" (or pbkdf2_sha256$iterations$salt$hash
+# where OpenSSL lacks scrypt). Accounts from before hashing still hold the
+# plaintext; it is checked once and replaced by a hash on the next login.
+
+PASSWORD_SCRYPT = (2 ** 14, 8, 1)  # n, r, p: ~16MB and tens of ms per hash
+PASSWORD_PBKDF2_ITERATIONS = 310000
+PASSWORD_SALT_BYTES = 16
+
+def hash_password(password):
+  salt = os.urandom(PASSWORD_SALT_BYTES)
+  if hasattr(hashlib, "scrypt"):
+    n, r, p = PASSWORD_SCRYPT
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=32)
+    return f"scrypt${n}${r}${p}${salt.hex()}${digest.hex()}"
+  digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, PASSWORD_PBKDF2_ITERATIONS)
+  return f"pbkdf2_sha256${PASSWORD_PBKDF2_ITERATIONS}${salt.hex()}${digest.hex()}"
+
+def is_password_hash(stored):
+  return stored.startswith(("scrypt$", "pbkdf2_sha256$"))
+
+def verify_password(password, stored):
+  parts = stored.split("$")
+  if parts[0] == "scrypt" and len(parts) == 6:
+    n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+    digest = hashlib.scrypt(password.encode(), salt=bytes.fromhex(parts[4]), n=n, r=r, p=p, dklen=32)
+    return hmac.compare_digest(digest.hex(), parts[5])
+  if parts[0] == "pbkdf2_sha256" and len(parts) == 4:
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(parts[2]), int(parts[1]))
+    return hmac.compare_digest(digest.hex(), parts[3])
+  return hmac.compare_digest(password.encode(), stored.encode())
+
+# Logins for unknown usernames are checked against this, so they take as
+# long as real ones and do not reveal which usernames exist.
+PASSWORD_DUMMY_HASH = hash_password(os.urandom(PASSWORD_SALT_BYTES).hex())
+
+def check_login(password, stored):
+  # -> (ok, replacement hash or None); runs in the pool
+  ok = verify_password(password, stored)
+  if ok and not is_password_hash(stored):
+    return True, hash_password(password)
+  return ok, None
+
+# ---------- PERSISTENCE ----------
+
+# Mutations are appended to an in-memory batch and group-committed to the
+# current write-ahead log segment by a background writer, so request
+# handlers never touch the disk. A snapshot is a consistent cut: the log is
+# rotated and all in-memory state is copied in one step without yielding,
+# then written out in chunks while traffic continues. Restart loads the
+# snapshot and replays only the segments from the rotation point on, which
+# matters because "admin_event", "bulk", "window" and "ledger" records are
+# not idempotent. Leaderboard blocks are part of the copy so restart does
+# not have to re-sort them.
+
+# Match replays are also written under DATA_DIR/replays unless REPLAY_DIR
+# says otherwise ("" turns them off); only the newest REPLAY_MAX_FILES are kept.
+DATA_DIR = os.environ.get("DATA_DIR", "data")  # empty string disables persistence
+WAL_COMMIT_INTERVAL = 0.05  # seconds between group commits
+SNAPSHOT_INTERVAL = int(os.environ.get("SNAPSHOT_INTERVAL", 600))  # seconds between snapshots
+SNAPSHOT_CHUNK = 10000  # users per snapshot frame
+SNAPSHOT_MAGIC = b"ECSNAP1\n"
+FRAME_HEADER = struct.Struct(">II")  # payload length, crc32
+
+LEADERBOARD_FIELDS = set(LEADERBOARD_SOURCES.values()) | {"is_first_bogacactus"}
+
+PERSIST = {
+    "enabled": False,
+    "pending": [],  # records waiting for the next group commit
+    "segment": 0,  # id of the WAL segment being appended to
+    "wal": None,
+    "lock": Semaphore(),  # serializes commits and segment rotation
+    "tasks": [],
+}
+
+def persist(record):
+  if PERSIST["enabled"]:
+    PERSIST["pending"].append(record)
+
+def persist_user(user, *fields):
+  if not PERSIST["enabled"]:
+    return
+  values = {}
+  for f in fields:
+    v = user[f]
+    values[f] = set(v) if isinstance(v, (set, OwnedSet)) else v
+  PERSIST["pending"].append(("set", user["id"], values))
+
+def encode_frame(obj):
+  payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+  return FRAME_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+def read_frames(f):
+  # Stops quietly at a torn or corrupt tail frame.
+  while True:
+    header = f.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+      return
+    length, crc = FRAME_HEADER.unpack(header)
+    payload = f.read(length)
+    if len(payload) < length or zlib.crc32(payload) != crc:
+      return
+    yield pickle.loads(payload)
+
+def wal_path(segment):
+  return os.path.join(DATA_DIR, f"wal-{segment:08d}.log")
+
+def snapshot_path(segment):
+  return os.path.join(DATA_DIR, f"snapshot-{segment:08d}.bin")
+
+def list_segments(prefix):
+  out = []
+  for name in os.listdir(DATA_DIR):
+    if name.startswith(prefix + "-"):
+      try:
+        out.append(int(name.split("-", 1)[1].split(".", 1)[0]))
+      except ValueError:
+        continue
+  return sorted(out)
+
+def open_wal_segment(segment):
+  if PERSIST["wal"] is not None:
+    PERSIST["wal"].close()
+  PERSIST["segment"] = segment
+  PERSIST["wal"] = open(wal_path(segment), "ab")
+
+def commit_wal():
+  with PERSIST["lock"]:
+    batch = PERSIST["pending"]
+    if not batch:
+      return
+    PERSIST["pending"] = []
+    f = PERSIST["wal"]
+    f.write(encode_frame(batch))
+    f.flush()
+    tpool.execute(os.fsync, f.fileno())
+
+def wal_writer_loop():
+  while True:
+    socketio.sleep(WAL_COMMIT_INTERVAL)
+    commit_wal()
+
+def apply_record(record):
+  kind = record[0]
+  if kind == "user":
+    user = USERS.add(record[1])
+    USERNAME_INDEX[user["username"]] = user["id"]
+    sync_user_leaderboards(user)
+  elif kind == "set":
+    user = USERS.get(record[1])
+    if user is not None:
+      user.update(record[2])
+      if not LEADERBOARD_FIELDS.isdisjoint(record[2]):
+        sync_user_leaderboards(user, record[2])
+  elif kind == "admin_event":
+    ADMIN_EVENTS.append(record[1])
+  elif kind == "scheduled_event":
+    SCHEDULED_EVENTS.append(record[1])
+  elif kind == "match_result":
+    mark_result_seen(record[1])
+  elif kind == "bulk":
+    apply_bulk(*record[1:])
+  elif kind == "window":
+    set_window_totals(*record[1:])
+  elif kind == "ledger":
+    append_ledger(*record[1:])
+
+def write_snapshot():
+  with PERSIST["lock"]:
+    # Rotation and every copy below happen without yielding, so each record
+    # lands either in the old segment (and the snapshot) or in the new one.
+    batch = PERSIST["pending"]
+    PERSIST["pending"] = []
+    previous = PERSIST["wal"]
+    if batch:
+      previous.write(encode_frame(batch))
+    previous.flush()
+    PERSIST["wal"] = None
+    segment = PERSIST["segment"] + 1
+    open_wal_segment(segment)
+    header = {
+      "segment": segment,
+      "created": now_ts(),
+      "users": len(USERS),
+      "admin_events": list(ADMIN_EVENTS),
+      "scheduled_events": list(SCHEDULED_EVENTS),
+      "match_results": list(RESULTS["seen"]),
+      "windows": {kind: (w["id"], w["key"], w["label"]) for kind, w in WINDOWS.items()},
+      "window_archive": {kind: list(archive) for kind, archive in WINDOW_ARCHIVE.items()},
+      "bulk_grants": list(BULK_GRANTS),
+    }
+    boards = {("board", stat): board.copy_blocks() for stat, board in LEADERBOARDS.items()}
+    for kind, window in WINDOWS.items():
+      for stat, board in window["boards"].items():
+        boards[("window_board", kind, stat)] = board.copy_blocks()
+    columns = USERS.copy_columns()
+    ledgers = [(user_id, bytes(ledger)) for user_id, ledger in LEDGERS.items()]
+    tpool.execute(os.fsync, previous.fileno())
+    previous.close()
+  # Boards reference users by store row, which keeps them small and lets
+  # the loader share the user id strings. Rows only ever get appended.
+  positions = USERS.index
+  tmp = snapshot_path(segment) + ".tmp"
+  with open(tmp, "wb") as f:
+    f.write(SNAPSHOT_MAGIC)
+    f.write(encode_frame(header))
+    for start in range(0, len(columns["id"]), SNAPSHOT_CHUNK):
+      chunk = {field: column[start:start + SNAPSHOT_CHUNK] for field, column in columns.items()}
+      f.write(encode_frame(("user_columns", chunk)))
+      socketio.sleep(0)
+    for start in range(0, len(ledgers), SNAPSHOT_CHUNK):
+      f.write(encode_frame(("ledgers", ledgers[start:start + SNAPSHOT_CHUNK])))
+      socketio.sleep(0)
+    blocks_per_frame = max(1, SNAPSHOT_CHUNK // RANK_BLOCK)
+    for tag, blocks in boards.items():
+      for start in range(0, len(blocks), blocks_per_frame):
+        columns = [
+          (array("I", [positions[key[1]] for key in block]), array("q", [-key[0] for key in block]))
+          for block in blocks[start:start + blocks_per_frame]
+        ]
+        f.write(encode_frame(tag + (columns,)))
+        socketio.sleep(0)
+    f.flush()
+    tpool.execute(os.fsync, f.fileno())
+  os.replace(tmp, snapshot_path(segment))
+  for old in list_segments("snapshot"):
+    if old < segment:
+      os.remove(snapshot_path(old))
+  for old in list_segments("wal"):
+    if old < segment:
+      os.remove(wal_path(old))
+  return segment
+
+def snapshot_loop():
+  while True:
+    socketio.sleep(SNAPSHOT_INTERVAL)
+    write_snapshot()
+
+def load_state():
+  USERS.clear()
+  USERNAME_INDEX.clear()
+  ADMIN_EVENTS.clear()
+  SCHEDULED_EVENTS.clear()
+  RESULTS["seen"].clear()
+  LEDGERS.clear()
+  BULK_GRANTS.clear()
+  for board in LEADERBOARDS.values():
+    board.load(())
+  clear_leaderboard_pages()
+  clear_windows()
+  # Millions of long-lived objects: collector passes would only slow the load.
+  gc.disable()
+  try:
+    first_segment = load_snapshot()
+    last_segment = first_segment
+    for segment in list_segments("wal"):
+      if segment < first_segment:
+        continue
+      with open(wal_path(segment), "rb") as f:
+        for batch in read_frames(f):
+          for record in batch:
+            apply_record(record)
+      last_segment = segment
+  finally:
+    gc.enable()
+  # Replay re-adds events that ended since their record was logged.
+  now = time.time()
+  SCHEDULED_EVENTS[:] = [e for e in SCHEDULED_EVENTS if not event_ended(e, now)]
+  gc.freeze()
+  return last_segment
+
+def load_snapshot():
+  snapshots = list_segments("snapshot")
+  if not snapshots:
+    return 0
+  segment = snapshots[-1]
+  boards = {stat: [] for stat in LEADERBOARDS}
+  window_boards = {}  # (kind, stat) -> blocks
+  user_ids = []  # snapshot position -> user id
+  with open(snapshot_path(segment), "rb") as f:
+    if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+      raise RuntimeError("bad snapshot file " + snapshot_path(segment))
+    frames = read_frames(f)
+    header = next(frames)
+    ADMIN_EVENTS.extend(header["admin_events"])
+    SCHEDULED_EVENTS.extend(header["scheduled_events"])
+    for room_id in header.get("match_results", ()):
+      mark_result_seen(room_id)
+    for kind, (wid, key, label) in header.get("windows", {}).items():
+      if wid is not None:
+        roll_window(kind, wid, key, label, header["created"])
+    for kind, archive in header.get("window_archive", {}).items():
+      WINDOW_ARCHIVE[kind].extend(archive)
+    BULK_GRANTS.extend(header.get("bulk_grants", ()))
+    for frame in frames:
+      if frame[0] == "user_columns":
+        USERS.load_columns(frame[1])
+        USERNAME_INDEX.update(zip(frame[1]["username"], frame[1]["id"]))
+        user_ids.extend(frame[1]["id"])
+      elif frame[0] == "users":  # snapshots from before the column store
+        for user in frame[1]:
+          USERS.add(user)
+          USERNAME_INDEX[user["username"]] = user["id"]
+          user_ids.append(user["id"])
+      elif frame[0] == "board":
+        boards[frame[1]].extend(frame[2])
+      elif frame[0] == "ledgers":
+        LEDGERS.update((user_id, bytearray(blob)) for user_id, blob in frame[1])
+      elif frame[0] == "window_board":
+        window_boards.setdefault((frame[1], frame[2]), []).extend(frame[3])
+  for stat, blocks in boards.items():
+    LEADERBOARDS[stat].load_blocks(
+      ([user_ids[p] for p in positions], values) for positions, values in blocks
+    )
+  for (kind, stat), blocks in window_boards.items():
+    WINDOWS[kind]["boards"][stat].load_blocks(
+      ([user_ids[p] for p in positions], values) for positions, values in blocks
+    )
+  return segment
+
+def init_persistence():
+  if not DATA_DIR:
+    return
+  os.makedirs(DATA_DIR, exist_ok=True)
+  last_segment = load_state()
+  # Never append after a possibly torn tail: start a fresh segment.
+  open_wal_segment(last_segment + 1)
+  PERSIST["enabled"] = True
+  PERSIST["tasks"] = [
+    socketio.start_background_task(wal_writer_loop),
+    socketio.start_background_task(snapshot_loop),
+  ]
+
+# ---------- ECONOMY ----------
+
+# Purchases, unlocks and claims run as transactions: each op checks and
+# updates a working copy of the user's balances and inventory, and only if
+# every op succeeds is the copy written back, with one WAL record and one
+# batch of ledger entries. Nothing in a transaction yields to the hub, so
+# transactions for the same user are serialized without a lock.
+# Every balance change is appended to the user's ledger as fixed 20-byte
+# records (time, currency, reason, ref, delta, balance after). Bulk grants
+# touch every user at once, so they are kept once in a global list and
+# merged into each covered user's ledger when it is read.
+
+ECONOMY_BATCH_MAX = 20  # ops per /economy/batch request
+LEDGER_ENTRY = struct.Struct("<IBBHiq")
+LEDGER_CURRENCIES = ["coins", "gems", "star_points"]
+LEDGER_REASONS = ["shop_buy", "character_unlock", "battlepass_claim", "match_reward"]
+LEDGER_PAGE_MAX = 200
+
+LEDGERS = {}  # user_id -> bytearray of LEDGER_ENTRY records, oldest first
+BULK_GRANTS = []  # (ts, currency, amount, users): store rows below users got the grant
+
+def append_ledger(user_id, blob, offset=None):
+  # offset is the ledger length the blob was first appended at, so replaying
+  # a record that is already in the loaded ledger is a no-op.
+  ledger = LEDGERS.get(user_id)
+  if ledger is None:
+    LEDGERS[user_id] = bytearray(blob)
+  elif offset is None or len(ledger) <= offset:
+    ledger += blob
+
+def record_ledger(user_id, entries):
+  # entries: [(currency, reason, ref, delta, balance)]
+  ts = now_ts()
+  blob = b"".join(
+    LEDGER_ENTRY.pack(ts, LEDGER_CURRENCIES.index(c), LEDGER_REASONS.index(r), ref, delta, balance)
+    for c, r, ref, delta, balance in entries
+  )
+  offset = len(LEDGERS.get(user_id) or b"")
+  append_ledger(user_id, blob)
+  persist(("ledger", user_id, blob, offset))
+
+def read_ledger(user_id, limit):
+  # newest first
+  ledger = LEDGERS.get(user_id) or b""
+  row = USERS.index.get(user_id, -1)
+  grants = [grant for grant in BULK_GRANTS if row < grant[3]]
+  out = []
+  end = len(ledger)
+  while len(out) < limit and (end or grants):
+    if end:
+      ts, c, r, ref, delta, balance = LEDGER_ENTRY.unpack_from(ledger, end - LEDGER_ENTRY.size)
+    if grants and (not end or grants[-1][0] > ts):
+      # The per-user balance after a bulk grant is not recorded.
+      ts, currency, amount, _ = grants.pop()
+      out.append({"ts": ts, "currency": currency, "reason": "bulk_grant", "ref": 0, "delta": amount, "balance": None})
+      continue
+    end -= LEDGER_ENTRY.size
+    out.append({
+      "ts": ts,
+      "currency": LEDGER_CURRENCIES[c],
+      "reason": LEDGER_REASONS[r],
+      "ref": ref,
+      "delta": delta,
+      "balance": balance,
+    })
+  return out
+
+def new_txn(user):
+  return {
+    "user": user,
+    "balances": {c: user[c] for c in LEDGER_CURRENCIES},
+    "bp_level": user["bp_level"],
+    "bp_xp": user["bp_xp"],
+    "bp_level_before": user["bp_level"],
+    "characters": [],  # unlocked in this transaction
+    "items": [],
+    "entries": [],  # ledger entries
+  }
+
+def txn_change(txn, currency, delta, reason, ref):
+  balance = txn["balances"][currency] + delta
+  if balance < 0:
+    return f"Not enough {currency}"
+  txn["balances"][currency] = balance
+  txn["entries"].append((currency, reason, ref, delta, balance))
+  return None
+
+def op_buy(txn, item_id):
+  item = next((i for i in SHOP_ITEMS if i["id"] == item_id), None)
+  if not item:
+    return "Invalid item"
+  if item_id in txn["user"]["owned_items"] or item_id in txn["items"]:
+    return "Already owned"
+  error = txn_change(txn, item["cost_currency"], -item["cost_amount"], "shop_buy", SHOP_ITEMS.index(item))
+  if error:
+    return error
+  txn["items"].append(item_id)
+  return None
+
+def op_unlock(txn, cid):
+  tmpl = next((c for c in CHARACTER_TEMPLATES if c["id"] == cid), None)
+  if not tmpl:
+    return "Invalid character"
+  if cid in txn["user"]["owned_characters"] or cid in txn["characters"]:
+    return "Already owned"
+  error = txn_change(txn, "coins", -tmpl["cost_coins"], "character_unlock", CHARACTER_TEMPLATES.index(tmpl))
+  if error:
+    return error
+  txn["characters"].append(cid)
+  return None
+
+def op_claim(txn, level_id):
+  try:
+    lvl_num = int(level_id.split("_")[1])
+  except Exception:
+    return "Invalid level"
+  if lvl_num != txn["bp_level"] + 1:
+    return "Not claimable"
+  if txn["bp_xp"] < 100:
+    return "Not enough BP XP"
+  txn["bp_level"] = lvl_num
+  txn["bp_xp"] = 0
+  return txn_change(txn, "coins", 100 * lvl_num, "battlepass_claim", lvl_num)
+
+ECONOMY_OPS = {  # op -> (argument key, handler)
+    "buy": ("item_id", op_buy),
+    "unlock": ("character_id", op_unlock),
+    "claim": ("level_id", op_claim),
+}
+
+def commit_txn(txn):
+  user = txn["user"]
+  fields = [c for c in LEDGER_CURRENCIES if user[c] != txn["balances"][c]]
+  for c in fields:
+    user[c] = txn["balances"][c]
+  if txn["bp_level"] != user["bp_level"]:
+    user["bp_level"] = txn["bp_level"]
+    user["bp_xp"] = txn["bp_xp"]
+    fields += ["bp_level", "bp_xp"]
+  if txn["characters"]:
+    owned = user["owned_characters"]
+    for cid in txn["characters"]:
+      owned.add(cid)
+    fields.append("owned_characters")
+  if txn["items"]:
+    owned = user["owned_items"]
+    for item_id in txn["items"]:
+      owned.add(item_id)
+    fields.append("owned_items")
+  if not fields:
+    return
+  touch_user(user)
+  persist_user(user, *fields)
+  if txn["entries"]:
+    record_ledger(user["id"], txn["entries"])
+  if "bp_level" in fields:
+    update_leaderboard("bp", user["id"], user["bp_level"])
+
+def txn_changes(txn):
+  # What a committed transaction changed, for delta responses.
+  user = txn["user"]
+  deltas = {}
+  for currency, _, _, delta, _ in txn["entries"]:
+    deltas[currency] = deltas.get(currency, 0) + delta
+  changes = {
+    "balances": {c: user[c] for c in deltas},
+    "deltas": deltas,
+    "characters_added": txn["characters"],
+    "items_added": txn["items"],
+    "version": user["version"],
+  }
+  if txn["bp_level"] != txn["bp_level_before"]:
+    changes["battlepass"] = {"level": user["bp_level"], "xp": user["bp_xp"]}
+  return changes
 
 # ---------- AUTH ROUTES ----------
 
 @app.route("/signup", methods=["POST"])
 def signup():
+  if not allow_request("signup"):
+    return too_many_requests("signup")
   data = request.get_json() or {}
   username = data.get("username", "").strip()
   password = data.get("password", "").strip()
@@ -232,12 +1626,18 @@ def signup():
     return "Missing username or password", 400
   if username in USERNAME_INDEX:
     return "Username already taken", 400
+  try:
+    password_hash = run_in_pool(hash_password, password)
+  except PoolBusy:
+    return pool_busy()
+  if username in USERNAME_INDEX:  # taken while hashing
+    return "Username already taken", 400
 
   user_id = str(uuid.uuid4())
   user = {
     "id": user_id,
     "username": username,
-    "password": password,  # dev only
+    "password": password_hash,
     "coins": 1000,
     "gems": 100,
     "star_points": 0,
@@ -251,43 +1651,45 @@ def signup():
     "bp_xp": 0,
     "admin_events_created": 0,
     "admin_events_triggered": 0,
+    "is_first_bogacactus": False,
+    "version": 1,  # bumped by touch_user on every change visible in /me
   }
   ensure_bogacactus_first(user)
 
-  USERS[user_id] = user
+  persist(("user", dict(user, owned_characters=set(user["owned_characters"]))))
+  user = USERS.add(user)
   USERNAME_INDEX[username] = user_id
 
-  update_leaderboard("wins", user_id, 0)
-  update_leaderboard("damage", user_id, 0)
-  update_leaderboard("kos", user_id, 0)
-  update_leaderboard("event_xp", user_id, 0)
-  update_leaderboard("bp", user_id, user["bp_level"])
-  if user.get("is_first_bogacactus"):
-    update_leaderboard("admin", user_id, 0)
-
-  token = generate_token()
-  TOKENS[token] = user_id
+  sync_user_leaderboards(user)
+  token = create_session(user_id)
 
   return jsonify({"token": token, "user": serialize_user(user)})
 
 @app.route("/login", methods=["POST"])
 def login():
+  if not allow_request("login"):
+    return too_many_requests("login")
   data = request.get_json() or {}
   username = data.get("username", "").strip()
   password = data.get("password", "").strip()
   if not username or not password:
     return "Missing username or password", 400
   user_id = USERNAME_INDEX.get(username)
-  if not user_id:
-    return "Invalid credentials", 400
-  user = USERS[user_id]
-  if user["password"] != password:
+  user = USERS[user_id] if user_id else None
+  try:
+    ok, upgraded = run_in_pool(check_login, password, user["password"] if user else PASSWORD_DUMMY_HASH)
+  except PoolBusy:
+    return pool_busy()
+  if not ok or not user:
     return "Invalid credentials", 400
+  if upgraded is not None and not is_password_hash(user["password"]):
+    user["password"] = upgraded
+    persist_user(user, "password")
 
-  ensure_bogacactus_first(user)
+  if ensure_bogacactus_first(user):
+    persist_user(user, "is_first_bogacactus")
 
-  token = generate_token()
-  TOKENS[token] = user_id
+  token = create_session(user_id)
   return jsonify({"token": token, "user": serialize_user(user)})
 
 @app.route("/me", methods=["GET"])
@@ -296,20 +1698,28 @@ def me():
   if not user:
     return "Unauthorized", 401
 
-  event = get_current_event()
-  chars = build_user_characters(user)
-  bp = build_battlepass(user)
-  shop = build_shop(user)
-  maps = build_maps()
+  fields = request.args.get("fields")
+  if fields:
+    wanted = set(fields.split(","))
+    sections = [name for name in ME_SECTIONS if name in wanted]
+    if not sections:
+      return "Invalid fields", 400
+  else:
+    sections = ME_SECTIONS
 
-  return jsonify({
-    "user": serialize_user(user),
-    "event": event,
-    "characters": chars,
-    "battlepass": bp,
-    "shop": shop,
-    "maps": maps,
-  })
+  catalog = get_catalog()
+  mask = sum(1 << ME_SECTIONS.index(name) for name in sections)
+  etag = f'{BOOT_ID}.{user["id"]}.{catalog["version"]}.{user["version"]}.{mask}'
+  if request.if_none_match.contains(etag):
+    resp = app.response_class(status=304)
+  else:
+    body = "{" + ",".join(
+      f'"{name}":' + render_me_section(name, user, catalog) for name in sections
+    ) + "}"
+    resp = app.response_class(body, mimetype="application/json")
+  resp.set_etag(etag)
+  resp.headers["Cache-Control"] = "private, no-cache"
+  return resp
 
 # ---------- CHARACTER ROUTES ----------
 
@@ -323,6 +1733,8 @@ def character_select():
   if cid not in user["owned_characters"]:
     return "Character not owned", 400
   user["selected_character_id"] = cid
+  touch_user(user)
+  persist_user(user, "selected_character_id")
   return jsonify({"ok": True})
 
 @app.route("/character/unlock", methods=["POST"])
@@ -331,17 +1743,11 @@ def character_unlock():
   if not user:
     return "Unauthorized", 401
   data = request.get_json() or {}
-  cid = data.get("character_id")
-  tmpl = next((c for c in CHARACTER_TEMPLATES if c["id"] == cid), None)
-  if not tmpl:
-    return "Invalid character", 400
-  if cid in user["owned_characters"]:
-    return "Already owned", 400
-  cost = tmpl["cost_coins"]
-  if user["coins"] < cost:
-    return "Not enough coins", 400
-  user["coins"] -= cost
-  user["owned_characters"].add(cid)
+  txn = new_txn(user)
+  error = op_unlock(txn, data.get("character_id"))
+  if error:
+    return error, 400
+  commit_txn(txn)
   chars = build_user_characters(user)
   return jsonify({
     "coins": user["coins"],
@@ -356,21 +1762,11 @@ def shop_buy():
   if not user:
     return "Unauthorized", 401
   data = request.get_json() or {}
-  item_id = data.get("item_id")
-  item = next((i for i in SHOP_ITEMS if i["id"] == item_id), None)
-  if not item:
-    return "Invalid item", 400
-
-  currency = item["cost_currency"]
-  amount = item["cost_amount"]
-  if currency == "coins":
-    if user["coins"] < amount:
-      return "Not enough coins", 400
-    user["coins"] -= amount
-  elif currency == "gems":
-    if user["gems"] < amount:
-      return "Not enough gems", 400
-    user["gems"] -= amount
+  txn = new_txn(user)
+  error = op_buy(txn, data.get("item_id"))
+  if error:
+    return error, 400
+  commit_txn(txn)
 
   chars = build_user_characters(user)
   return jsonify({
@@ -388,24 +1784,11 @@ def battlepass_claim():
   if not user:
     return "Unauthorized", 401
   data = request.get_json() or {}
-  level_id = data.get("level_id")
-  try:
-    lvl_num = int(level_id.split("_")[1])
-  except Exception:
-    lvl_num = None
-  if lvl_num is None:
-    return "Invalid level", 400
-
-  if lvl_num != user["bp_level"] + 1:
-    return "Not claimable", 400
-  if user["bp_xp"] < 100:
-    return "Not enough BP XP", 400
-
-  user["bp_level"] += 1
-  user["bp_xp"] = 0
-  user["coins"] += 100 * lvl_num
-
-  update_leaderboard("bp", user["id"], user["bp_level"])
+  txn = new_txn(user)
+  error = op_claim(txn, data.get("level_id"))
+  if error:
+    return error, 400
+  commit_txn(txn)
 
   bp = build_battlepass(user)
   chars = build_user_characters(user)
@@ -417,18 +1800,115 @@ def battlepass_claim():
     "battlepass": bp,
   })
 
+# ---------- ECONOMY ROUTES ----------
+
+@app.route("/economy/batch", methods=["POST"])
+def economy_batch():
+  # {"ops": [{"op": "buy", "item_id": ...}, {"op": "unlock", "character_id": ...},
+  #          {"op": "claim", "level_id": ...}]}, applied all-or-nothing in order.
+  user = get_user_from_token()
+  if not user:
+    return "Unauthorized", 401
+  data = request.get_json() or {}
+  ops = data.get("ops")
+  if not isinstance(ops, list) or not ops:
+    return "Missing ops", 400
+  if len(ops) > ECONOMY_BATCH_MAX:
+    return f"At most {ECONOMY_BATCH_MAX} ops per batch", 400
+  txn = new_txn(user)
+  for i, op in enumerate(ops):
+    spec = ECONOMY_OPS.get(op.get("op")) if isinstance(op, dict) else None
+    if spec is None:
+      return f"Op {i}: invalid op", 400
+    key, handler = spec
+    error = handler(txn, op.get(key))
+    if error:
+      return f"Op {i}: {error}", 400
+  commit_txn(txn)
+  return jsonify(txn_changes(txn))
+
+@app.route("/economy/ledger", methods=["GET"])
+def economy_ledger():
+  user = get_user_from_token()
+  if not user:
+    return "Unauthorized", 401
+  limit = parse_count_arg("limit", 50, 1, LEDGER_PAGE_MAX)
+  if limit is None:
+    return "Invalid limit", 400
+  return jsonify({"entries": read_ledger(user["id"], limit)})
+
 # ---------- LEADERBOARD ROUTES ----------
 
+def requested_board(stat):
+  # All-time board, or the open window named by ?window=; None if invalid.
+  window = request.args.get("window", "all")
+  if window == "all":
+    return LEADERBOARDS.get(stat)
+  if window not in WINDOW_KINDS or stat not in WINDOW_STATS:
+    return None
+  return get_window_board(window, stat)
+
 @app.route("/leaderboard/<stat>", methods=["GET"])
 def leaderboard(stat):
   user = get_user_from_token()
   if not user:
     return "Unauthorized", 401
-  if stat not in LEADERBOARDS:
-    return "Invalid stat", 400
-  limit = int(request.args.get("limit", 75))
-  entries = get_leaderboard_entries(stat, limit=limit)
-  return jsonify({"entries": entries})
+  board = requested_board(stat)
+  if board is None:
+    return "Invalid stat or window", 400
+  limit = parse_count_arg("limit", LEADERBOARD_PAGE_DEFAULT, 1, LEADERBOARD_PAGE_MAX)
+  if limit is None:
+    return "Invalid limit", 400
+  cursor = request.args.get("cursor")
+  if cursor:
+    after = decode_leaderboard_cursor(cursor)
+    if after is None:
+      return "Invalid cursor", 400
+    return jsonify(get_leaderboard_page(board, limit, after))
+  if board is not LEADERBOARDS[stat]:
+    return jsonify(get_leaderboard_page(board, limit))
+  return app.response_class(get_top_page_body(stat, limit), mimetype="application/json")
+
+@app.route("/leaderboard/<stat>/around", methods=["GET"])
+def leaderboard_around(stat):
+  user = get_user_from_token()
+  if not user:
+    return "Unauthorized", 401
+  board = requested_board(stat)
+  if board is None:
+    return "Invalid stat or window", 400
+  k = parse_count_arg("k", LEADERBOARD_AROUND_DEFAULT, 0, LEADERBOARD_AROUND_MAX)
+  if k is None:
+    return "Invalid k", 400
+  rank = board.rank(user["id"])
+  if rank is None:
+    return jsonify({"rank": None, "value": 0, "entries": []})
+  offset = max(0, rank - 1 - k)
+  entries = build_leaderboard_entries(board.slice(offset, rank + k - offset), offset + 1)
+  return jsonify({"rank": rank, "value": board.get(user["id"]), "entries": entries})
+
+@app.route("/leaderboard/<stat>/archive", methods=["GET"])
+def leaderboard_archive(stat):
+  user = get_user_from_token()
+  if not user:
+    return "Unauthorized", 401
+  kind = request.args.get("window", "daily")
+  if kind not in WINDOW_KINDS or stat not in WINDOW_STATS:
+    return "Invalid stat or window", 400
+  closed = [{"label": c["label"], "closed": c["closed"]} for c in reversed(WINDOW_ARCHIVE[kind])]
+  return jsonify({"window": kind, "closed": closed})
+
+@app.route("/leaderboard/<stat>/archive/<kind>/<label>", methods=["GET"])
+def leaderboard_archive_top(stat, kind, label):
+  user = get_user_from_token()
+  if not user:
+    return "Unauthorized", 401
+  if kind not in WINDOW_KINDS or stat not in WINDOW_STATS:
+    return "Invalid stat or window", 400
+  closed = get_window_archive(kind, label)
+  if closed is None:
+    return "Window not found", 404
+  return app.response_class(closed["tops"][stat], mimetype="application/json")
 
 @app.route("/leaderboard/rank", methods=["GET"])
 def leaderboard_rank():
@@ -444,6 +1924,58 @@ def leaderboard_rank():
   in_top_75 = rank <= 75
   return jsonify({"rank": rank, "value": value, "in_top_75": in_top_75})
 
+# ---------- MAP ROUTES ----------
+
+@app.route("/maps/<int:template>/<int:seed>", methods=["GET"])
+def map_layout(template, seed):
+  if template >= len(MAP_TEMPLATES) or seed > 0xFFFFFFFF:
+    return "Unknown map", 404
+  resp = app.response_class(serialize_json(generate_map_layout(template, seed)), mimetype="application/json")
+  # layouts never change for a given (template, seed)
+  resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+  return resp
+
+# ---------- REPLAY ROUTES ----------
+
+@app.route("/replays/<room_id>", methods=["GET"])
+def replay_download(room_id):
+  user = get_user_from_token()
+  if not user:
+    return "Unauthorized", 401
+  try:
+    room_id = str(uuid.UUID(room_id))
+  except ValueError:
+    return "Replay not found", 404
+  path = replay_path(room_id) if REPLAY_DIR else None
+  if not path or not os.path.exists(path):
+    return "Replay not found", 404
+  resp = app.response_class(stream_replay(path), mimetype="application/octet-stream")
+  resp.headers["Content-Length"] = str(os.path.getsize(path))
+  resp.headers["Content-Disposition"] = f"attachment; filename={room_id}.replay"
+  return resp
+
+# ---------- MATCHMAKING ROUTES ----------
+
+@app.route("/matchmaking/stats", methods=["GET"])
+def matchmaking_stats():
+  user = get_user_from_token()
+  if not user:
+    return "Unauthorized", 401
+  now = time.monotonic()
+  return jsonify({mode: queue.stats(now) for mode, queue in MATCH_QUEUES.items()})
+
+@app.route("/spectate/rooms", methods=["GET"])
+def spectate_rooms():
+  user = get_user_from_token()
+  if not user:
+    return "Unauthorized", 401
+  if BUS["role"] == "front":
+    live = [room_id for room_id, info in ROOM_SHARD.items() if not info["finished"]]
+  else:
+    live = [room_id for room_id, match in MATCHES.items() if not match["finished"]]
+  rooms = sorted(live, key=lambda room_id: -len(SPECTATORS.get(room_id, ())))[:50]
+  return jsonify({"rooms": [{"room_id": r, "spectators": len(SPECTATORS.get(r, ()))} for r in rooms]})
+
 # ---------- ADMIN ROUTES ----------
 
 def is_admin_user(user):
@@ -460,13 +1992,16 @@ def admin_trigger():
   preset = data.get("preset")
   user["admin_events_triggered"] += 1
   update_leaderboard("admin", user["id"], user["admin_events_triggered"])
-  ADMIN_EVENTS.append({
+  entry = {
     "type": "preset",
     "preset": preset,
     "by": user["username"],
     "ts": now_ts(),
-  })
-  socketio.emit("event_update", get_current_event(), broadcast=True)
+  }
+  ADMIN_EVENTS.append(entry)
+  persist(("admin_event", entry))
+  persist_user(user, "admin_events_triggered")
+  broadcast("event_update", get_current_event())
   return jsonify({"ok": True})
 
 @app.route("/admin/event/schedule", methods=["POST"])
@@ -481,14 +2016,26 @@ def admin_schedule():
   theme = data.get("theme", "dark")
   start = data.get("start")
   end = data.get("end")
-  SCHEDULED_EVENTS.append({
+  try:
+    starts_at = parse_event_time(start)
+    ends_at = parse_event_time(end)
+  except ValueError:
+    return "Invalid start or end", 400
+  if starts_at is not None and ends_at is not None and ends_at <= starts_at:
+    return "End must be after start", 400
+  entry = {
     "name": name,
     "theme": theme,
     "start": start,
     "end": end,
     "by": user["username"],
-  })
+  }
+  ensure_event_scheduler()
+  SCHEDULED_EVENTS.append(entry)
+  persist(("scheduled_event", entry))
+  schedule_event(entry)
   user["admin_events_created"] += 1
+  persist_user(user, "admin_events_created")
   update_leaderboard("admin", user["id"], user["admin_events_triggered"])
   return jsonify({"ok": True})
 
@@ -501,35 +2048,308 @@ def admin_custom():
     return "Forbidden", 403
   data = request.get_json() or {}
   config = data.get("config", {})
-  ADMIN_EVENTS.append({
+  entry = {
     "type": "custom",
     "config": config,
     "by": user["username"],
     "ts": now_ts(),
-  })
+  }
+  ADMIN_EVENTS.append(entry)
+  persist(("admin_event", entry))
   user["admin_events_created"] += 1
+  persist_user(user, "admin_events_created")
   update_leaderboard("admin", user["id"], user["admin_events_triggered"])
   return jsonify({"ok": True})
 
-# ---------- MATCHMAKING & MATCH STATE ----------
+# Bulk operations run over whole user columns and are logged as one
+# relative record. They hold the persistence lock, so a snapshot never
+# both contains one and replays it from the next WAL segment.
+
+BULK_CURRENCIES = {"coins", "gems", "star_points"}
+
+def grant_all(currency, amount, ts):
+  USERS.add_to_all(currency, amount)
+  USERS.add_to_all("version", 1)
+  BULK_GRANTS.append((ts, currency, amount, len(USERS)))
+
+def reset_battlepass():
+  USERS.fill("bp_level", 1)
+  USERS.fill("bp_xp", 0)
+  USERS.add_to_all("version", 1)
+  LEADERBOARDS["bp"].load(zip(USERS.strs["id"], USERS.ints["bp_level"]))
+  clear_leaderboard_pages("bp")
+
+def apply_bulk(op, *args):
+  if op == "grant":
+    grant_all(*args)
+  elif op == "season_reset":
+    reset_battlepass()
+
+def run_bulk(op, *args):
+  with PERSIST["lock"]:
+    apply_bulk(op, *args)
+    persist(("bulk", op) + args)
+
+@app.route("/admin/bulk/grant", methods=["POST"])
+def admin_bulk_grant():
+  user = get_user_from_token()
+  if not user:
+    return "Unauthorized", 401
+  if not is_admin_user(user):
+    return "Forbidden", 403
+  data = request.get_json() or {}
+  currency = data.get("currency")
+  amount = data.get("amount")
+  if currency not in BULK_CURRENCIES:
+    return "Invalid currency", 400
+  if not isinstance(amount, int) or isinstance(amount, bool) or not 0 < amount <= 1000000:
+    return "Invalid amount", 400
+  run_bulk("grant", currency, amount, now_ts())
+  return jsonify({"ok": True, "users": len(USERS)})
+
+@app.route("/admin/season/reset", methods=["POST"])
+def admin_season_reset():
+  user = get_user_from_token()
+  if not user:
+    return "Unauthorized", 401
+  if not is_admin_user(user):
+    return "Forbidden", 403
+  run_bulk("season_reset")
+  return jsonify({"ok": True, "users": len(USERS)})
+
+@app.route("/admin/stats/percentiles", methods=["GET"])
+def admin_percentiles():
+  user = get_user_from_token()
+  if not user:
+    return "Unauthorized", 401
+  if not is_admin_user(user):
+    return "Forbidden", 403
+  field = request.args.get("field", "coins")
+  if field not in USERS.ints or field == "version":
+    return "Invalid field", 400
+  try:
+    qs = [float(q) for q in request.args.get("q", "50,90,99").split(",")]
+  except ValueError:
+    return "Invalid percentiles", 400
+  if len(qs) > 20 or any(not 0 <= q <= 100 for q in qs):
+    return "Invalid percentiles", 400
+  values = USERS.percentiles(field, qs)
+  return jsonify({"field": field, "users": len(USERS), "percentiles": {f"{q:g}": v for q, v in zip(qs, values)}})
+
+# ---------- EVENT SCHEDULER ----------
+
+# The base event rotates through EVENTS on fixed wall-clock boundaries, so
+# every process and every restart agree on it without stored state. An
+# active scheduled event overrides the rotation; when several overlap, the
+# one that started last wins. Start, end and rotation times sit in one heap
+# that a single green thread sleeps on; scheduling an earlier entry wakes
+# it. Each change of the current event rebuilds the /me catalog (new
+# ETags) and is broadcast once as event_update.
+
+EVENT_ROTATION_INTERVAL = int(os.environ.get("EVENT_ROTATION_INTERVAL", 7 * 24 * 3600))  # seconds per EVENTS entry
+EVENT_SCHEDULER_MAX_SLEEP = 60  # re-check at least this often in case the wall clock jumps
+EVENT_PALETTES = [build_event_palette(base) for base in EVENTS]
+
+EVENT_SCHEDULER = {
+    "heap": [],  # (ts, seq, kind, entry), kind in rotate/start/end
+    "seq": 0,
+    "active": [],  # (entry, palette) of started scheduled events, oldest first
+    "task": None,
+    "wake": None,
+}
+
+def rotation_index(ts):
+  return int(ts // EVENT_ROTATION_INTERVAL) % len(EVENTS)
+
+def parse_event_time(value):
+  # Unix seconds or an ISO 8601 string (naive means UTC); None if unset.
+  if value is None or value == "":
+    return None
+  if isinstance(value, bool):
+    raise ValueError(value)
+  if isinstance(value, (int, float)):
+    return float(value)
+  if not isinstance(value, str):
+    raise ValueError(value)
+  try:
+    return float(value)
+  except ValueError:
+    pass
+  dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+  if dt.tzinfo is None:
+    dt = dt.replace(tzinfo=timezone.utc)
+  return dt.timestamp()
+
+def schedule_at(ts, kind, entry=None):
+  sched = EVENT_SCHEDULER
+  sched["seq"] += 1
+  heapq.heappush(sched["heap"], (ts, sched["seq"], kind, entry))
+  wake = sched["wake"]
+  if wake is not None and not wake.ready() and sched["heap"][0][1] == sched["seq"]:
+    wake.send()
+
+def event_ended(entry, now):
+  try:
+    ends_at = parse_event_time(entry.get("end"))
+  except ValueError:
+    return True
+  return ends_at is not None and ends_at <= now
+
+def schedule_event(entry):
+  try:
+    starts_at = parse_event_time(entry.get("start"))
+    ends_at = parse_event_time(entry.get("end"))
+  except ValueError:
+    return
+  now = time.time()
+  if ends_at is not None and ends_at <= now:
+    return
+  schedule_at(starts_at if starts_at is not None else now, "start", entry)
+  if ends_at is not None:
+    schedule_at(ends_at, "end", entry)
+
+def current_event_palette():
+  active = EVENT_SCHEDULER["active"]
+  if active:
+    return active[-1][1]
+  return EVENT_PALETTES[CURRENT_EVENT_INDEX]
+
+def run_due_events(now):
+  global CURRENT_EVENT_INDEX
+  sched = EVENT_SCHEDULER
+  heap = sched["heap"]
+  before = get_current_event()
+  while heap and heap[0][0] <= now:
+    ts, _, kind, entry = heapq.heappop(heap)
+    if kind == "rotate":
+      CURRENT_EVENT_INDEX = rotation_index(ts)
+      schedule_at((ts // EVENT_ROTATION_INTERVAL + 1) * EVENT_ROTATION_INTERVAL, "rotate")
+    elif kind == "start":
+      palette = build_event_palette({"event_name": entry.get("name") or "Scheduled Event", "theme": entry.get("theme")})
+      sched["active"].append((entry, palette))
+    elif kind == "end":
+      sched["active"] = [a for a in sched["active"] if a[0] is not entry]
+      SCHEDULED_EVENTS[:] = [e for e in SCHEDULED_EVENTS if e is not entry]
+  current = current_event_palette()
+  if current is not before:
+    publish_event(current)
+
+def publish_event(palette):
+  global CURRENT_EVENT
+  CURRENT_EVENT = palette
+  rebuild_catalog()
+  broadcast("event_update", palette)
+
+def event_scheduler_loop():
+  sched = EVENT_SCHEDULER
+  while True:
+    run_due_events(time.time())
+    delay = sched["heap"][0][0] - time.time() if sched["heap"] else EVENT_SCHEDULER_MAX_SLEEP
+    sched["wake"] = Event()
+    sched["wake"].wait(timeout=max(0.0, min(delay, EVENT_SCHEDULER_MAX_SLEEP)))
+
+def ensure_event_scheduler():
+  # On first start, seed the heap with the next rotation boundary and with
+  # SCHEDULED_EVENTS (as restored by load_state). Entries whose start has
+  # already passed fire on the first run.
+  global CURRENT_EVENT_INDEX
+  if EVENT_SCHEDULER["task"] is not None:
+    return
+  now = time.time()
+  CURRENT_EVENT_INDEX = rotation_index(now)
+  get_current_event()
+  schedule_at((now // EVENT_ROTATION_INTERVAL + 1) * EVENT_ROTATION_INTERVAL, "rotate")
+  for entry in SCHEDULED_EVENTS:
+    schedule_event(entry)
+  EVENT_SCHEDULER["task"] = socketio.start_background_task(event_scheduler_loop)
+
+# ---------- MAP GENERATION ----------
+
+# A layout is a pure function of (template index into MAP_TEMPLATES, seed),
+# so matches only carry that pair and clients rebuild the geometry locally
+# (or fetch it once from /maps/<template>/<seed>). The generator uses
+# mulberry32 seeded with (seed ^ Math.imul(template, 0x9E3779B9)) >>> 0, so
+# it ports to JS bit-for-bit.
+#
+# The pool is the first MAP_POOL_SIZE valid seeds per template, built at
+# import; every process (front and shard workers) gets the same pool.
+
+MAP_POOL_SIZE = int(os.environ.get("MAP_POOL_SIZE", "64"))
+MAP_MIN_GAP = 0.02  # clearance between platforms, and between platforms and hazards
+
+MAP_POOL = []  # layouts matches are drawn from
+
+def map_rng(template, seed):
+  state = [(seed ^ (template * 0x9E3779B9)) & 0xFFFFFFFF]
+
+  def next_float():
+    state[0] = t = (state[0] + 0x6D2B79F5) & 0xFFFFFFFF
+    t = ((t ^ (t >> 15)) * (t | 1)) & 0xFFFFFFFF
+    t ^= (t + (((t ^ (t >> 7)) * (t | 61)) & 0xFFFFFFFF)) & 0xFFFFFFFF
+    return (t ^ (t >> 14)) / 4294967296
+
+  return next_float
+
+def generate_map_layout(template, seed):
+  rand = map_rng(template, seed)
+
+  def uniform(lo, hi):
+    return lo + (hi - lo) * rand()
 
-def build_initial_map():
   platforms = []
-  for _ in range(random.randint(3, 6)):
+  for _ in range(3 + int(rand() * 4)):
+    w = uniform(0.2, 0.4)
     platforms.append({
-      "x": random.uniform(0.1, 0.7),
-      "y": random.uniform(0.2, 0.8),
-      "w": random.uniform(0.2, 0.4),
-      "h": random.uniform(0.03, 0.06),
+      "x": uniform(0.05, 0.95 - w),
+      "y": uniform(0.2, 0.8),
+      "w": w,
+      "h": uniform(0.03, 0.06),
     })
   hazards = []
-  if random.random() < 0.4:
+  if rand() < 0.4:
     hazards.append({
       "x": 0.5,
       "y": 0.9,
       "r": 0.15,
     })
-  return {"platforms": platforms, "hazards": hazards}
+  return {"template": template, "seed": seed, "platforms": platforms, "hazards": hazards}
+
+def validate_map_layout(layout):
+  platforms = layout["platforms"]
+  for p in platforms:
+    if p["x"] < 0 or p["y"] < 0 or p["x"] + p["w"] > 1 or p["y"] + p["h"] > 1:
+      return False
+  for i, a in enumerate(platforms):
+    for b in platforms[i + 1:]:
+      if (a["x"] < b["x"] + b["w"] + MAP_MIN_GAP and b["x"] < a["x"] + a["w"] + MAP_MIN_GAP
+          and a["y"] < b["y"] + b["h"] + MAP_MIN_GAP and b["y"] < a["y"] + a["h"] + MAP_MIN_GAP):
+        return False
+  for hz in layout["hazards"]:
+    for p in platforms:
+      dx = hz["x"] - min(max(hz["x"], p["x"]), p["x"] + p["w"])
+      dy = hz["y"] - min(max(hz["y"], p["y"]), p["y"] + p["h"])
+      if dx * dx + dy * dy < (hz["r"] + MAP_MIN_GAP) ** 2:
+        return False
+  return True
+
+def build_map_pool(size):
+  pool = []
+  for template in range(len(MAP_TEMPLATES)):
+    seed = found = 0
+    while found < size:
+      layout = generate_map_layout(template, seed)
+      if validate_map_layout(layout):
+        pool.append(layout)
+        found += 1
+      seed += 1
+  MAP_POOL[:] = pool
+
+def pick_map_layout():
+  return random.choice(MAP_POOL)
+
+build_map_pool(MAP_POOL_SIZE)
+
+# ---------- MATCHMAKING & MATCH STATE ----------
 
 def build_player_state(user, is_me=False, team=1):
   selected_id = user.get("selected_character_id", "fighter_1")
@@ -551,80 +2371,217 @@ def build_player_state(user, is_me=False, team=1):
     "is_me": is_me,
     "moving": False,
     "screen_pos": {"x": 0.5, "y": 0.5},
+    "connected": True,
   }
 
-def create_match(room_id, players):
+def create_match(room_id, players, binary=(), mode="1v1"):
   event = get_current_event()
-  map_state = build_initial_map()
+  layout = pick_map_layout()
   match = {
     "room_id": room_id,
+    "mode": mode,
     "players": players,
-    "map": map_state,
+    "map": {"template": layout["template"], "seed": layout["seed"]},
+    "layout": layout,  # server-side geometry, never sent
     "active_pickups": [],
     "finished": False,
     "winning_team": None,
+    "inputs": deque(),  # (sid, action, pos) queued for the next tick
+    "seq": 0,
+    "keyframe_seq": 0,
+    "sent": {},  # sid -> player fields as of the last emitted update
+    "wire": build_wire(players, binary),  # None unless some sid negotiated msgpack
+    "created_at": time.monotonic(),
+    "last_input_at": time.monotonic(),
+    "finished_at": None,
+    "abandoned_at": None,
   }
+  init_combat(match)
+  match["replay"] = new_replay(match)
   MATCHES[room_id] = match
+  ensure_tick_loop()
   return match
 
+def snapshot_player(p):
+  return {k: (v.copy() if isinstance(v, dict) else v) for k, v in p.items()}
+
+def mark_keyframe_sent(match):
+  match["sent"] = {sid: snapshot_player(p) for sid, p in match["players"].items()}
+  match["keyframe_seq"] = match["seq"]
+
+def build_keyframe(match):
+  return {
+    "type": "keyframe",
+    "seq": match["seq"],
+    "room_id": match["room_id"],
+    "players": match["players"],
+    "map": match["map"],
+    "active_pickups": match["active_pickups"],
+    "finished": match["finished"],
+    "winning_team": match["winning_team"],
+  }
+
+def build_delta(match):
+  sent = match["sent"]
+  players = {}
+  for sid, p in match["players"].items():
+    prev = sent.get(sid)
+    if prev is None:
+      changed = snapshot_player(p)
+      sent[sid] = snapshot_player(p)
+    else:
+      changed = {}
+      for k, v in p.items():
+        if prev.get(k) != v:
+          changed[k] = v.copy() if isinstance(v, dict) else v
+      prev.update(changed)
+    if changed:
+      players[sid] = changed
+  delta = {
+    "type": "delta",
+    "seq": match["seq"],
+    "room_id": match["room_id"],
+    "players": players,
+  }
+  if match["finished"]:
+    delta["finished"] = True
+    delta["winning_team"] = match["winning_team"]
+  return delta
+
+def emit_state(match):
+  match["seq"] += 1
+  if match["seq"] - match["keyframe_seq"] >= KEYFRAME_INTERVAL or match["finished"]:
+    payload = build_keyframe(match)
+    mark_keyframe_sent(match)
+  else:
+    payload = build_delta(match)
+    if not payload["players"]:
+      match["seq"] -= 1
+      return
+  emit_to_room("state_update", payload, match["room_id"], match["wire"])
+
+def emit_match_start(match):
+  payload = build_keyframe(match)
+  mark_keyframe_sent(match)
+  emit_to_room("match_start", payload, match["room_id"], match["wire"])
+
+def player_rating(user):
+  # Placeholder skill estimate until real MMR exists.
+  return 1000 + user["wins"] * 20 + user["kos"] * 5
+
 def queue_player(user, mode, sid):
-  if mode == "1v1":
-    QUEUE_1V1.append((user, sid))
-    if len(QUEUE_1V1) >= 2:
-      (u1, s1), (u2, s2) = QUEUE_1V1[:2]
-      del QUEUE_1V1[:2]
-      start_1v1(u1, s1, u2, s2)
-  elif mode == "2v2":
-    QUEUE_2V2.append((user, sid))
-    if len(QUEUE_2V2) >= 4:
-      players = QUEUE_2V2[:4]
-      del QUEUE_2V2[:4]
-      start_2v2(players)
+  queue = MATCH_QUEUES.get(mode)
+  if queue is None:
+    return
+  if sid_in_live_match(sid):
+    return
+  for other in MATCH_QUEUES.values():
+    if other is not queue:
+      other.remove(sid)
+  queue.add(user, sid, player_rating(user), time.monotonic())
+  ensure_matchmaking_loop()
+
+def dequeue_player(sid):
+  for queue in MATCH_QUEUES.values():
+    queue.remove(sid)
+
+def run_matchmaking():
+  # -> True while a queue is part way through a pass. Groups are started
+  # right after their sweep slice, before anything yields, so every sid in
+  # them is still connected.
+  now = time.monotonic()
+  for group in MATCH_QUEUES["1v1"].sweep(now):
+    t1, t2 = group
+    start_1v1(t1["user"], t1["sid"], t2["user"], t2["sid"])
+  for group in MATCH_QUEUES["2v2"].sweep(now):
+    start_2v2([(t["user"], t["sid"]) for t in group])
+  for group in MATCH_QUEUES["ffa"].sweep(now):
+    start_ffa([(t["user"], t["sid"]) for t in group])
+  return any(queue.cursor for queue in MATCH_QUEUES.values())
+
+def matchmaking_loop():
+  # Slices of a pass run back to back with a yield in between, so a long
+  # queue delays the tick loop by one slice at most.
+  delay = MM_SWEEP_INTERVAL
+  while True:
+    socketio.sleep(delay)
+    delay = 0 if run_matchmaking() else MM_SWEEP_INTERVAL
+
+def ensure_matchmaking_loop():
+  if MATCHMAKING_LOOP["task"] is None:
+    MATCHMAKING_LOOP["task"] = socketio.start_background_task(matchmaking_loop)
+
+def join_match_room(sid, room_id):
+  old_room = SID_ROOM.get(sid)
+  if old_room and old_room != room_id:
+    socketio.server.leave_room(sid, wire_room(old_room, sid), namespace="/")
+  socketio.server.enter_room(sid, wire_room(room_id, sid), namespace="/")
+  SID_ROOM[sid] = room_id
 
 def start_1v1(u1, s1, u2, s2):
   room_id = str(uuid.uuid4())
-  join_room(room_id, sid=s1)
-  join_room(room_id, sid=s2)
+  join_match_room(s1, room_id)
+  join_match_room(s2, room_id)
   p1 = build_player_state(u1, is_me=False, team=1)
   p2 = build_player_state(u2, is_me=False, team=2)
-  match = create_match(room_id, {
+  launch_match(room_id, {
     s1: p1,
     s2: p2,
-  })
-  socketio.emit("match_start", match, room=room_id)
+  }, "1v1")
 
 def start_2v2(players):
   room_id = str(uuid.uuid4())
   players_state = {}
-  teams = [1, 1, 2, 2]
-  random.shuffle(teams)
+  # strongest + weakest vs the middle two
+  players = sorted(players, key=lambda entry: player_rating(entry[0]))
+  teams = [1, 2, 2, 1]
   for (user, sid), team in zip(players, teams):
-    join_room(room_id, sid=sid)
+    join_match_room(sid, room_id)
     players_state[sid] = build_player_state(user, is_me=False, team=team)
-  match = create_match(room_id, players_state)
-  socketio.emit("match_start", match, room=room_id)
+  launch_match(room_id, players_state, "2v2")
+
+def start_ffa(players):
+  # Everyone is their own team, spawned evenly around the arena.
+  room_id = str(uuid.uuid4())
+  players_state = {}
+  for i, (user, sid) in enumerate(players):
+    join_match_room(sid, room_id)
+    p = build_player_state(user, is_me=False, team=i + 1)
+    angle = 2 * math.pi * i / len(players)
+    p["screen_pos"] = {"x": 0.5 + FFA_SPAWN_RADIUS * math.cos(angle), "y": 0.5 + FFA_SPAWN_RADIUS * math.sin(angle)}
+    players_state[sid] = p
+  launch_match(room_id, players_state, "ffa")
+
+def launch_match(room_id, players_state, mode):
+  binary = [sid for sid in players_state if sid in BINARY_SIDS]
+  if BUS["role"] == "front":
+    shard = shard_for_room(room_id)
+    ROOM_SHARD[room_id] = {"shard": shard, "finished": False}
+    bus_send(BUS["shards"][shard], ("create", room_id, players_state, binary, mode))
+    return
+  match = create_match(room_id, players_state, binary, mode)
+  emit_match_start(match)
 
-def apply_action(room_id, sid, action):
+def apply_action(room_id, sid, action, pos=None):
   match = MATCHES.get(room_id)
   if not match or match["finished"]:
     return
-  players = match["players"]
-  if sid not in players:
+  p = match["players"].get(sid)
+  if p is None or p["hp"] <= 0:
     return
-  p = players[sid]
 
-  if action == "LIGHT_ATTACK":
-    for oid, op in players.items():
-      if oid != sid and op["team"] != p["team"]:
-        op["hp"] = max(0, op["hp"] - p["damage"])
-        p["eclipse_meter"] = min(100, p["eclipse_meter"] + 5)
-        p["moving"] = True
+  if action == "MOVE":
+    move_player(match, sid, p, pos)
+  elif action == "LIGHT_ATTACK":
+    for oid in targets_in_range(match, sid, p, ATTACK_RANGES[action]):
+      deal_damage(match, sid, oid, p["damage"])
+      p["eclipse_meter"] = min(100, p["eclipse_meter"] + 5)
+      p["moving"] = True
   elif action == "HEAVY_ATTACK":
-    for oid, op in players.items():
-      if oid != sid and op["team"] != p["team"]:
-        op["hp"] = max(0, op["hp"] - int(p["damage"] * 1.5))
-        p["eclipse_meter"] = min(100, p["eclipse_meter"] + 10)
-        p["moving"] = True
+    for oid in targets_in_range(match, sid, p, ATTACK_RANGES[action]):
+      deal_damage(match, sid, oid, int(p["damage"] * 1.5))
+      p["eclipse_meter"] = min(100, p["eclipse_meter"] + 10)
+      p["moving"] = True
   elif action == "BLOCK":
     p["blocking"] = True
     p["block_stamina"] = max(0, p["block_stamina"] - 5)
@@ -632,67 +2589,1402 @@ def apply_action(room_id, sid, action):
     p["moving"] = True
   elif action == "ECLIPSE":
     if p["eclipse_meter"] >= 100:
-      for oid, op in players.items():
-        if oid != sid and op["team"] != p["team"]:
-          op["hp"] = max(0, op["hp"] - p["damage"] * 2)
+      for oid in targets_in_range(match, sid, p, ATTACK_RANGES[action]):
+        deal_damage(match, sid, oid, p["damage"] * 2)
       p["eclipse_meter"] = 0
       p["moving"] = True
 
-  for oid, op in players.items():
-    if op["hp"] <= 0:
-      match["finished"] = True
-      match["winning_team"] = p["team"]
-      break
+# Hit resolution is positional: an attack reaches opponents whose hitbox
+# centre is within its range plus PLAYER_HITBOX of the attacker. Candidates
+# come from a uniform grid of GRID_CELL squares (cell -> {sid: True}), which
+# MOVE updates incrementally, so an attack only looks at nearby players.
+# Until a client sends MOVE everyone in 1v1/2v2 stands at the centre and
+# every opponent is in range, as before.
+
+def init_combat(match):
+  match["tally"] = {sid: [0, 0] for sid in match["players"]}  # sid -> [damage dealt, kos]
+  match["grid"] = {}  # (cx, cy) -> {sid: True}
+  match["cells"] = {}  # sid -> (cx, cy)
+  match["alive"] = {}  # team -> players with hp left
+  for sid, p in match["players"].items():
+    grid_place(match, sid, p["screen_pos"])
+    match["alive"][p["team"]] = match["alive"].get(p["team"], 0) + 1
+
+def grid_cell(pos):
+  return (int(pos["x"] / GRID_CELL), int(pos["y"] / GRID_CELL))
+
+def grid_place(match, sid, pos):
+  cell = grid_cell(pos)
+  old = match["cells"].get(sid)
+  if old == cell:
+    return
+  if old is not None:
+    grid_remove(match, sid)
+  match["grid"].setdefault(cell, {})[sid] = True
+  match["cells"][sid] = cell
+
+def grid_remove(match, sid):
+  cell = match["cells"].pop(sid, None)
+  if cell is None:
+    return
+  members = match["grid"][cell]
+  del members[sid]
+  if not members:
+    del match["grid"][cell]
+
+def targets_in_range(match, sid, p, reach):
+  pos = p["screen_pos"]
+  x, y = pos["x"], pos["y"]
+  reach += PLAYER_HITBOX
+  reach2 = reach * reach
+  grid = match["grid"]
+  players = match["players"]
+  team = p["team"]
+  hits = []
+  for cx in range(int((x - reach) // GRID_CELL), int((x + reach) // GRID_CELL) + 1):
+    for cy in range(int((y - reach) // GRID_CELL), int((y + reach) // GRID_CELL) + 1):
+      members = grid.get((cx, cy))
+      if not members:
+        continue
+      for oid in members:
+        op = players[oid]
+        if op["team"] == team:
+          continue
+        opos = op["screen_pos"]
+        dx = opos["x"] - x
+        dy = opos["y"] - y
+        if dx * dx + dy * dy <= reach2:
+          hits.append(oid)
+  return hits
+
+def move_player(match, sid, p, pos):
+  # pos is quantized to 0..MOVE_QUANT per axis; each MOVE covers at most
+  # speed * MOVE_STEP.
+  pos_now = p["screen_pos"]
+  x, y = pos[0] / MOVE_QUANT, pos[1] / MOVE_QUANT
+  dx, dy = x - pos_now["x"], y - pos_now["y"]
+  step = p["speed"] * MOVE_STEP
+  dist = math.hypot(dx, dy)
+  if dist > step:
+    x = pos_now["x"] + dx * step / dist
+    y = pos_now["y"] + dy * step / dist
+  p["screen_pos"] = {"x": x, "y": y}
+  p["moving"] = True
+  grid_place(match, sid, p["screen_pos"])
+
+def parse_move(data):
+  x, y = data.get("x"), data.get("y")
+  if type(x) not in (int, float) or type(y) not in (int, float):
+    return None
+  if not (0 <= x <= 1 and 0 <= y <= 1):
+    return None
+  return (round(x * MOVE_QUANT), round(y * MOVE_QUANT))
+
+def deal_damage(match, sid, oid, amount):
+  target = match["players"][oid]
+  before = target["hp"]
+  target["hp"] = max(0, before - amount)
+  tally = match["tally"][sid]
+  tally[0] += before - target["hp"]
+  if before > 0 and target["hp"] == 0:
+    tally[1] += 1
+    knock_out(match, sid, oid)
+
+def knock_out(match, sid, oid):
+  # 1v1/2v2 end on the first KO; free-for-all ends when one team is left.
+  grid_remove(match, oid)
+  alive = match["alive"]
+  alive[match["players"][oid]["team"]] -= 1
+  if match["mode"] == "ffa" and sum(1 for n in alive.values() if n) > 1:
+    return
+  match["finished"] = True
+  match["finished_at"] = time.monotonic()
+  match["winning_team"] = match["players"][sid]["team"]
+
+def queue_action(room_id, sid, action, pos=None):
+  match = MATCHES.get(room_id)
+  if not match or match["finished"]:
+    return
+  if len(match["inputs"]) >= MAX_PENDING_INPUTS:
+    return
+  match["inputs"].append((sid, action, pos))
+  PENDING_ROOMS.add(room_id)
+
+def run_match_tick(match):
+  inputs = match["inputs"]
+  room_id = match["room_id"]
+  match["last_input_at"] = time.monotonic()
+  was_finished = match["finished"]
+  replay = match["replay"]
+  while inputs:
+    sid, action, pos = inputs.popleft()
+    record_input(replay, sid, action, pos)
+    apply_action(room_id, sid, action, pos)
+  emit_state(match)
+  if match["finished"] and not was_finished:
+    on_match_finished(match)
+
+def on_match_finished(match):
+  save_replay(match)
+  result = build_match_result(match)
+  if BUS["role"] == "worker":
+    bus_send(BUS["front"], ("finished", match["room_id"]))
+    bus_send(BUS["front"], ("result", result))
+  else:
+    submit_match_result(result)
+
+def run_tick():
+  TICK_LOOP["tick"] += 1
+  rooms = list(PENDING_ROOMS)
+  PENDING_ROOMS.clear()
+  for room_id in rooms:
+    match = MATCHES.get(room_id)
+    if match:
+      run_match_tick(match)
+  if TICK_LOOP["tick"] % (TICK_RATE * MATCH_GC_INTERVAL) == 0:
+    collect_matches()
+
+def tick_loop():
+  interval = 1.0 / TICK_RATE
+  next_tick = time.monotonic()
+  while True:
+    run_tick()
+    next_tick += interval
+    delay = next_tick - time.monotonic()
+    if delay < 0:
+      # fell behind: skip the missed ticks instead of bursting to catch up
+      next_tick = time.monotonic()
+      delay = 0
+    socketio.sleep(delay)
+
+def player_left_match(room_id, sid):
+  match = MATCHES.get(room_id)
+  if not match or sid not in match["players"]:
+    return
+  match["players"][sid]["connected"] = False
+  if not any(p["connected"] for p in match["players"].values()):
+    match["abandoned_at"] = time.monotonic()
+  elif not match["finished"]:
+    PENDING_ROOMS.add(room_id)
+
+def evict_match(room_id):
+  match = MATCHES.pop(room_id, None)
+  if not match:
+    return
+  PENDING_ROOMS.discard(room_id)
+  save_replay(match)  # abandoned matches never reached on_match_finished
+  if BUS["role"] == "worker":
+    bus_send(BUS["front"], ("evicted", room_id, list(match["players"])))
+  else:
+    release_match_room(room_id, match["players"])
+
+def release_match_room(room_id, sids):
+  for sid in sids:
+    if SID_ROOM.get(sid) == room_id:
+      del SID_ROOM[sid]
+  socketio.server.close_room(room_id, namespace="/")
+  socketio.server.close_room(room_id + WIRE_ROOM_SUFFIX, namespace="/")
+  release_spectators(room_id)
+
+def collect_matches():
+  now = time.monotonic()
+  expired = []
+  for room_id, match in MATCHES.items():
+    done_at = match["finished_at"] or match["abandoned_at"]
+    if done_at is not None:
+      if now - done_at >= MATCH_GC_GRACE:
+        expired.append(room_id)
+    elif now - match["last_input_at"] >= MATCH_IDLE_TIMEOUT:
+      expired.append(room_id)
+  for room_id in expired:
+    evict_match(room_id)
+
+def ensure_tick_loop():
+  if TICK_LOOP["task"] is None:
+    TICK_LOOP["task"] = socketio.start_background_task(tick_loop)
+
+def send_event(event, payload, room):
+  if BUS["role"] == "worker":
+    bus_send(BUS["front"], ("emit", room, encode_event(event, payload)))
+  else:
+    socketio.emit(event, payload, room=room)
+
+def emit_to_room(event, payload, room, wire=None):
+  # With a wire (see build_wire) msgpack sids sit in the room's binary twin
+  # and get the compact encoding, each format encoded once per emit.
+  if wire is None:
+    send_event(event, payload, room)
+    return
+  if wire["json"]:
+    send_event(event, payload, room)
+  if event in WIRE_EVENTS:
+    payload = encode_wire(payload, wire["slots"])
+  send_event(event, payload, room + WIRE_ROOM_SUFFIX)
+
+def emit_to_player(match, event, payload, sid):
+  wire = match["wire"]
+  if wire is not None and sid in wire["binary"] and event in WIRE_EVENTS:
+    payload = encode_wire(payload, wire["slots"])
+  send_event(event, payload, sid)
+
+def sid_in_live_match(sid):
+  room_id = SID_ROOM.get(sid)
+  if room_id is None:
+    return False
+  if BUS["role"] == "front":
+    info = ROOM_SHARD.get(room_id)
+    return bool(info) and not info["finished"]
+  match = MATCHES.get(room_id)
+  return bool(match) and not match["finished"]
 
-  socketio.emit("state_update", match, room=room_id)
+def route_action(room_id, sid, action, pos=None):
+  if BUS["role"] == "front":
+    info = ROOM_SHARD.get(room_id)
+    if info and not info["finished"]:
+      bus_send(BUS["shards"][info["shard"]], ("input", room_id, sid, action, pos))
+    return
+  queue_action(room_id, sid, action, pos)
+
+def route_leave(room_id, sid):
+  if BUS["role"] == "front":
+    info = ROOM_SHARD.get(room_id)
+    if info:
+      bus_send(BUS["shards"][info["shard"]], ("leave", room_id, sid))
+    return
+  player_left_match(room_id, sid)
+
+def route_resync(room_id, sid):
+  if BUS["role"] == "front":
+    info = ROOM_SHARD.get(room_id)
+    if info:
+      bus_send(BUS["shards"][info["shard"]], ("resync", room_id, sid))
+    return
+  match = MATCHES.get(room_id)
+  if not match or sid not in match["players"]:
+    return
+  emit_to_player(match, "state_update", build_keyframe(match), sid)
+
+# ---------- MATCH REPLAYS ----------
+
+# Every match records the inputs it actually applied, in order, as parallel
+# arrays (tick, player slot, action code, ms since creation, quantized MOVE
+# target), plus the mode, player states and map at creation. apply_action
+# only depends on that order, so simulate_replay() reproduces the final
+# state exactly.
+#
+# File layout (little-endian):
+#   REPLAY_MAGIC
+#   u32 header length, JSON header (room, mode, map, players, result, input count)
+#   ticks u32[n], slots u8[n], actions u8[n], ms u32[n], x u16[n], y u16[n]
+# ECRPLY1 files predate MOVE and stop after ms.
+
+REPLAY_DIR = os.environ.get("REPLAY_DIR", os.path.join(DATA_DIR, "replays") if DATA_DIR else "")
+REPLAY_MAX_FILES = int(os.environ.get("REPLAY_MAX_FILES", 20000))  # oldest replays beyond this are deleted
+REPLAY_MAGIC = b"ECRPLY2\n"
+REPLAY_COLUMNS = [("ticks", "I"), ("slot", "B"), ("action", "B"), ("ms", "I"), ("x", "H"), ("y", "H")]
+REPLAY_VERSIONS = {b"ECRPLY1\n": REPLAY_COLUMNS[:4], REPLAY_MAGIC: REPLAY_COLUMNS}
+REPLAY_MAX_INPUTS = 200000  # inputs recorded per match; later ones mark the replay truncated
+REPLAY_CHUNK = 65536  # bytes per streamed chunk
+REPLAY_HEADER = struct.Struct("<I")
+ACTION_CODES = {name: i for i, name in enumerate(ACTION_COSTS)}
+ACTION_NAMES = list(ACTION_COSTS)
+
+def new_replay(match):
+  players = match["players"]
+  return {
+    "slots": {sid: i for i, sid in enumerate(players)},
+    "players": [snapshot_player(p) for p in players.values()],
+    "map": match["map"],
+    "started_at": now_ts(),
+    "start_tick": TICK_LOOP["tick"],
+    "created_at": match["created_at"],
+    "ticks": array("I"),
+    "slot": array("B"),
+    "action": array("B"),
+    "ms": array("I"),
+    "x": array("H"),
+    "y": array("H"),
+    "truncated": False,
+    "saved": False,
+  }
+
+def record_input(replay, sid, action, pos=None):
+  if len(replay["ticks"]) >= REPLAY_MAX_INPUTS:
+    replay["truncated"] = True
+    return
+  replay["ticks"].append(TICK_LOOP["tick"] - replay["start_tick"])
+  replay["slot"].append(replay["slots"].get(sid, 255))
+  replay["action"].append(ACTION_CODES.get(action, 255))
+  replay["ms"].append(int((time.monotonic() - replay["created_at"]) * 1000))
+  x, y = pos or (0, 0)
+  replay["x"].append(x)
+  replay["y"].append(y)
+
+def replay_path(room_id):
+  return os.path.join(REPLAY_DIR, f"{room_id}.replay")
+
+def encode_replay(match):
+  replay = match["replay"]
+  header = {
+      "room_id": match["room_id"],
+      "mode": match["mode"],
+      "started_at": replay["started_at"],
+      "tick_rate": TICK_RATE,
+      "map": replay["map"],
+      "players": replay["players"],
+      "actions": ACTION_NAMES,
+      "finished": match["finished"],
+      "winning_team": match["winning_team"],
+      "inputs": len(replay["ticks"]),
+      "truncated": replay["truncated"],
+  }
+  header = json.dumps(header, separators=(",", ":")).encode()
+  parts = [REPLAY_MAGIC, REPLAY_HEADER.pack(len(header)), header]
+  for name, _ in REPLAY_COLUMNS:
+    column = replay[name]
+    if sys.byteorder == "big":
+      column = array(column.typecode, column)
+      column.byteswap()
+    parts.append(column.tobytes())
+  return b"".join(parts)
+
+def write_replay_file(path, blob):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  tmp = path + ".tmp"
+  with open(tmp, "wb") as f:
+    f.write(blob)
+  os.replace(tmp, path)
+
+def save_replay(match):
+  replay = match["replay"]
+  if not REPLAY_DIR or replay["saved"]:
+    return
+  replay["saved"] = True
+  socketio.start_background_task(run_in_pool, write_replay, match, shed=False)
+
+def write_replay(match):
+  # runs in the worker pool; a finished match's inputs no longer change
+  write_replay_file(replay_path(match["room_id"]), encode_replay(match))
+  prune_replays()
+
+def prune_replays():
+  # Concurrent writes prune too, so files may vanish while we look.
+  files = []
+  with os.scandir(REPLAY_DIR) as it:
+    for entry in it:
+      if entry.name.endswith(".replay"):
+        try:
+          files.append((entry.stat().st_mtime, entry.path))
+        except FileNotFoundError:
+          pass
+  if len(files) <= REPLAY_MAX_FILES:
+    return
+  files.sort()
+  for _, path in files[:len(files) - REPLAY_MAX_FILES]:
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      pass
+
+def load_replay(path):
+  with open(path, "rb") as f:
+    layout = REPLAY_VERSIONS.get(f.read(len(REPLAY_MAGIC)))
+    if layout is None:
+      raise ValueError("not a replay file")
+    (length,) = REPLAY_HEADER.unpack(f.read(REPLAY_HEADER.size))
+    header = json.loads(f.read(length))
+    columns = {}
+    for name, typecode in layout:
+      column = array(typecode)
+      column.fromfile(f, header["inputs"])
+      if sys.byteorder == "big":
+        column.byteswap()
+      columns[name] = column
+  return header, columns
+
+def simulate_replay(path):
+  # Re-run the recorded inputs through apply_action on a scratch match and
+  # return it; compare players/finished/winning_team against the header.
+  header, columns = load_replay(path)
+  sids = [f"replay-slot-{i}" for i in range(len(header["players"]))]
+  room_id = f"replay-{uuid.uuid4()}"
+  match = {
+      "room_id": room_id,
+      "mode": header.get("mode", "1v1"),
+      "players": {sid: dict(p) for sid, p in zip(sids, header["players"])},
+      "finished": False,
+      "finished_at": None,
+      "winning_team": None,
+  }
+  init_combat(match)
+  n = header["inputs"]
+  xs = columns.get("x") or array("H", bytes(2 * n))
+  ys = columns.get("y") or array("H", bytes(2 * n))
+  MATCHES[room_id] = match
+  try:
+    for slot, code, x, y in zip(columns["slot"], columns["action"], xs, ys):
+      if slot < len(sids) and code < len(header["actions"]):
+        action = header["actions"][code]
+        apply_action(room_id, sids[slot], action, (x, y) if action == "MOVE" else None)
+  finally:
+    MATCHES.pop(room_id, None)
+  return match
+
+def stream_replay(path):
+  with open(path, "rb") as f:
+    while True:
+      chunk = f.read(REPLAY_CHUNK)
+      if not chunk:
+        return
+      yield chunk
+
+# ---------- MATCH RESULTS ----------
+
+# Finished matches only append a small result tuple to a queue, so match
+# end costs the same however many stats and boards it touches. A
+# background worker drains the queue in batches. It sums the deltas per
+# user across the batch, then applies each user's fields, WAL record and
+# leaderboard updates once. Each room_id is applied at most once: seen ids
+# are logged with the same group commit as the stat changes and kept in
+# snapshots.
+
+RESULT_BATCH_INTERVAL = 0.25  # seconds between batches
+RESULT_BATCH_MAX = 1000  # results per batch
+RESULT_SEEN_MAX = 200000  # room_ids remembered for deduplication
+RESULT_FIELDS = ["wins", "damage", "kos", "event_xp", "bp_xp", "coins"]
+RESULT_REWARDS = {  # per player per finished match
+    "win": {"coins": 50, "bp_xp": 25, "event_xp": 30},
+    "loss": {"coins": 15, "bp_xp": 10, "event_xp": 10},
+}
+
+RESULTS = {
+    "queue": deque(),  # results waiting for the worker
+    "seen": OrderedDict(),  # room_id -> True, oldest first
+    "task": None,
+    "applied": 0,
+    "duplicates": 0,
+}
+
+def build_match_result(match):
+  tally = match["tally"]
+  return {
+    "room_id": match["room_id"],
+    "winning_team": match["winning_team"],
+    "players": [(p["user_id"], p["team"], tally[sid][0], tally[sid][1]) for sid, p in match["players"].items()],
+  }
+
+def submit_match_result(result):
+  RESULTS["queue"].append(result)
+  if RESULTS["task"] is None:
+    RESULTS["task"] = socketio.start_background_task(result_worker_loop)
+
+def mark_result_seen(room_id):
+  seen = RESULTS["seen"]
+  seen[room_id] = True
+  while len(seen) > RESULT_SEEN_MAX:
+    seen.popitem(last=False)
+
+def apply_match_results():
+  queue = RESULTS["queue"]
+  seen = RESULTS["seen"]
+  deltas = {}  # user_id -> {field: delta}
+  applied = 0
+  while queue and applied < RESULT_BATCH_MAX:
+    result = queue.popleft()
+    room_id = result["room_id"]
+    if room_id in seen:
+      RESULTS["duplicates"] += 1
+      continue
+    mark_result_seen(room_id)
+    persist(("match_result", room_id))
+    applied += 1
+    for user_id, team, damage, kos in result["players"]:
+      won = team == result["winning_team"]
+      d = deltas.get(user_id)
+      if d is None:
+        d = deltas[user_id] = dict.fromkeys(RESULT_FIELDS, 0)
+      d["wins"] += won
+      d["damage"] += damage
+      d["kos"] += kos
+      for field, amount in RESULT_REWARDS["win" if won else "loss"].items():
+        d[field] += amount
+  for user_id, d in list(deltas.items()):
+    user = USERS.get(user_id)
+    if user is None:
+      del deltas[user_id]
+      continue
+    for field, amount in d.items():
+      user[field] += amount
+    touch_user(user)
+    persist_user(user, *RESULT_FIELDS)
+    if d["coins"]:
+      record_ledger(user_id, [("coins", "match_reward", 0, d["coins"], user["coins"])])
+    sync_user_leaderboards(user, RESULT_FIELDS)
+  record_window_credits(deltas)
+  RESULTS["applied"] += applied
+  return applied
+
+def result_worker_loop():
+  while True:
+    socketio.sleep(RESULT_BATCH_INTERVAL)
+    while apply_match_results() >= RESULT_BATCH_MAX:
+      socketio.sleep(0)
+
+# ---------- LEADERBOARD WINDOWS ----------
+
+# Daily, weekly and per-event boards rank what each player gained inside
+# the window, credited from the same batched match-result deltas as the
+# all-time boards. Each kind has one open window. When the window id
+# changes (new UTC day, new ISO week, different current event), rollover
+# swaps in fresh empty boards. The closed window's top N is frozen to
+# serialized JSON right away (a short slice per stat), and the old boards
+# are torn down a few blocks at a time by a background task. Credits are
+# logged as the resulting per-window totals with their timestamp and event
+# window, so WAL replay opens and closes the same windows it did live and
+# applying a record twice does not count it twice.
+
+WINDOW_KINDS = ["daily", "weekly", "event"]
+WINDOW_STATS = ["wins", "damage", "kos", "event_xp"]
+WINDOW_TOP_N = 100  # entries frozen per closed window and stat
+WINDOW_ARCHIVE_MAX = {"daily": 35, "weekly": 16, "event": 16}  # closed windows kept per kind
+WINDOW_TEARDOWN_BLOCKS = 8  # retired board blocks freed per yield
+
+WINDOWS = {kind: {"id": None, "key": None, "label": None, "boards": {}} for kind in WINDOW_KINDS}
+WINDOW_ARCHIVE = {kind: deque(maxlen=WINDOW_ARCHIVE_MAX[kind]) for kind in WINDOW_KINDS}
+WINDOW_RETIRED = {
+    "boards": deque(),  # closed RankedIndexes waiting to be freed
+    "task": None,
+}
+
+def event_window_key():
+  active = EVENT_SCHEDULER["active"]
+  if active:
+    entry = active[-1][0]
+    return f"scheduled:{entry.get('start')}:{entry.get('name')}", entry.get("name") or "Scheduled Event"
+  period = int(time.time() // EVENT_ROTATION_INTERVAL)
+  return f"rotation:{period}", EVENTS[period % len(EVENTS)]["event_name"]
+
+def live_event_window():
+  # -> (id, key, label). Event window ids count event changes, so like
+  # day and week numbers they only grow.
+  key, label = event_window_key()
+  window = WINDOWS["event"]
+  if window["id"] is None:
+    return 0, key, label
+  if key == window["key"]:
+    return window["id"], key, label
+  return window["id"] + 1, key, label
+
+def window_id(kind, ts, event):
+  # -> (id, key, label) of the window ts falls in
+  day = int(ts // 86400)
+  if kind == "daily":
+    return day, day, datetime.fromtimestamp(day * 86400, timezone.utc).date().isoformat()
+  if kind == "weekly":
+    week = (day + 3) // 7  # 1970-01-01 was a Thursday; weeks start on Monday
+    year, number, _ = datetime.fromtimestamp((week * 7 - 3) * 86400, timezone.utc).isocalendar()
+    return week, week, f"{year}-W{number:02d}"
+  return event
+
+def open_window(kind, ts, event):
+  # The open window for ts, rolling over if ts starts a new one. None when
+  # ts belongs to a window that has already closed (late WAL records).
+  wid, key, label = window_id(kind, ts, event)
+  window = WINDOWS[kind]
+  if wid == window["id"]:
+    return window
+  if window["id"] is not None and wid < window["id"]:
+    return None
+  return roll_window(kind, wid, key, label, ts)
+
+def roll_window(kind, wid, key, label, ts):
+  old = WINDOWS[kind]
+  WINDOWS[kind] = {"id": wid, "key": key, "label": label, "boards": {stat: RankedIndex() for stat in WINDOW_STATS}}
+  if old["id"] is not None:
+    WINDOW_ARCHIVE[kind].append(freeze_window(kind, old, ts))
+    WINDOW_RETIRED["boards"].extend(old["boards"].values())
+    if WINDOW_RETIRED["task"] is None:
+      WINDOW_RETIRED["task"] = socketio.start_background_task(window_teardown_loop)
+  return WINDOWS[kind]
+
+def freeze_window(kind, window, ts):
+  tops = {}
+  for stat, board in window["boards"].items():
+    tops[stat] = serialize_json({
+      "stat": stat,
+      "window": kind,
+      "label": window["label"],
+      "closed": int(ts),
+      "entries": build_leaderboard_entries(board.slice(0, WINDOW_TOP_N), 1),
+    })
+  return {"id": window["id"], "label": window["label"], "closed": int(ts), "tops": tops}
+
+def window_teardown_loop():
+  boards = WINDOW_RETIRED["boards"]
+  while boards:
+    board = boards[0]
+    if board.blocks:
+      del board.blocks[-WINDOW_TEARDOWN_BLOCKS:]
+    elif board.values:
+      values = board.values
+      for _ in range(min(len(values), WINDOW_TEARDOWN_BLOCKS * RANK_BLOCK)):
+        values.popitem()
+    else:
+      boards.popleft()
+    socketio.sleep(0)
+  WINDOW_RETIRED["task"] = None
+
+def credit_windows(ts, event, items):
+  # items: [(user_id, {stat: amount})] -> {kind: [(user_id, {stat: total})]}
+  totals = {}
+  for kind in WINDOW_KINDS:
+    window = open_window(kind, ts, event)
+    if window is None:
+      continue
+    boards = window["boards"]
+    credited = []
+    for user_id, amounts in items:
+      values = {}
+      for stat, amount in amounts.items():
+        board = boards[stat]
+        values[stat] = board.get(user_id, 0) + amount
+        board.set(user_id, values[stat])
+      credited.append((user_id, values))
+    totals[kind] = credited
+  return totals
+
+def set_window_totals(ts, event, totals):
+  for kind, credited in totals.items():
+    window = open_window(kind, ts, event)
+    if window is None:
+      continue
+    boards = window["boards"]
+    for user_id, values in credited:
+      for stat, value in values.items():
+        boards[stat].set(user_id, value)
+
+def record_window_credits(deltas):
+  items = []
+  for user_id, d in deltas.items():
+    amounts = {stat: d[stat] for stat in WINDOW_STATS if d[stat]}
+    if amounts:
+      items.append((user_id, amounts))
+  if not items:
+    return
+  ts = time.time()
+  event = live_event_window()
+  totals = credit_windows(ts, event, items)
+  persist(("window", ts, event, totals))
+
+def get_window_board(kind, stat):
+  return open_window(kind, time.time(), live_event_window())["boards"][stat]
+
+def get_window_archive(kind, label):
+  for closed in reversed(WINDOW_ARCHIVE[kind]):
+    if closed["label"] == label:
+      return closed
+  return None
+
+def clear_windows():
+  for kind in WINDOW_KINDS:
+    WINDOWS[kind] = {"id": None, "key": None, "label": None, "boards": {}}
+    WINDOW_ARCHIVE[kind].clear()
+
+# ---------- MATCH SHARDING ----------
+
+# With MATCH_SHARDS > 0 the server process becomes the "front": it keeps
+# HTTP, sessions, matchmaking and Socket.IO rooms, and hands every match to
+# one of N worker processes picked by consistent hashing on room_id. The
+# workers run the same tick loop and match code; instead of emitting they
+# ship pre-encoded Socket.IO packets back over a Unix socket and the front
+# writes them to the room's connections without re-encoding. Messages in
+# both directions are batched per hub iteration into one frame.
+
+MATCH_SHARDS = int(os.environ.get("MATCH_SHARDS", 0))  # worker processes, 0 = simulate in-process
+BUS_PATH = os.environ.get("BUS_PATH", "")  # Unix socket path, defaults to one per front pid
+SHARD_VNODES = 64  # ring points per shard
+
+BUS = {
+    "role": "local",  # "local", "front" or "worker"
+    "shards": [],  # front: shard index -> connection
+    "front": None,  # worker: connection to the front
+    "ring": [],  # sorted (hash, shard index)
+    "ring_keys": [],
+    "procs": [],
+    "listener": None,
+}
+ROOM_SHARD = {}  # front: room_id -> {"shard", "finished"}
+
+def shard_hash(key):
+  return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+def build_shard_ring(count):
+  ring = sorted((shard_hash(f"shard-{i}-{v}"), i) for i in range(count) for v in range(SHARD_VNODES))
+  BUS["ring"] = ring
+  BUS["ring_keys"] = [h for h, _ in ring]
+
+def shard_for_room(room_id):
+  i = bisect.bisect(BUS["ring_keys"], shard_hash(room_id)) % len(BUS["ring"])
+  return BUS["ring"][i][1]
+
+def encode_event(event, payload, namespace="/"):
+  encoded = socketio.server.packet_class(sio_packet.EVENT, namespace=namespace, data=[event, payload]).encode()
+  return encoded if isinstance(encoded, list) else [encoded]
+
+def send_encoded(room, encoded, namespace="/"):
+  # Write an already-encoded Socket.IO packet to every sid in room. Local
+  # packets were counted by MetricsJSON when encode_event built them.
+  pkts = [eio_packet.Packet(eio_packet.MESSAGE, p) for p in encoded]
+  server = socketio.server
+  for _, eio_sid in server.manager.get_participants(namespace, room):
+    for p in pkts:
+      server._send_eio_packet(eio_sid, p)
+
+def count_bus_emit(encoded):
+  # Packets from a worker were encoded, and counted, in the worker process.
+  event = encoded[0][encoded[0].find('["') + 2:encoded[0].find('",')]
+  count_emit(event, sum(len(p) for p in encoded))
+
+def bus_connection(sock):
+  return {"sock": sock, "rfile": sock.makefile("rb"), "outbox": [], "flushing": False, "closed": False}
+
+def bus_send(conn, msg):
+  # Messages for a peer that has gone away (shutdown, crashed worker) are dropped.
+  if conn["closed"]:
+    return
+  conn["outbox"].append(msg)
+  if not conn["flushing"]:
+    conn["flushing"] = True
+    socketio.start_background_task(bus_flush, conn)
+
+def bus_flush(conn):
+  try:
+    while conn["outbox"]:
+      batch = conn["outbox"]
+      conn["outbox"] = []
+      conn["sock"].sendall(encode_frame(batch))
+  except OSError:
+    conn["closed"] = True
+    conn["outbox"] = []
+  finally:
+    conn["flushing"] = False
+
+def bus_messages(conn):
+  for batch in read_frames(conn["rfile"]):
+    yield from batch
+
+def handle_shard_message(msg):
+  # front side: messages from a worker
+  kind = msg[0]
+  if kind == "emit":
+    count_bus_emit(msg[2])
+    send_encoded(msg[1], msg[2])
+  elif kind == "finished":
+    info = ROOM_SHARD.get(msg[1])
+    if info:
+      info["finished"] = True
+  elif kind == "evicted":
+    ROOM_SHARD.pop(msg[1], None)
+    release_match_room(msg[1], msg[2])
+  elif kind == "result":
+    submit_match_result(msg[1])
+  elif kind == "spectate_emit":
+    count_bus_emit(msg[2])
+    deliver_spectators(msg[1], msg[2])
+
+def handle_front_message(msg):
+  # worker side: messages from the front
+  kind = msg[0]
+  if kind == "input":
+    queue_action(msg[1], msg[2], msg[3], msg[4])
+  elif kind == "create":
+    emit_match_start(create_match(msg[1], msg[2], msg[3], msg[4]))
+  elif kind == "leave":
+    player_left_match(msg[1], msg[2])
+  elif kind == "resync":
+    match = MATCHES.get(msg[1])
+    if match and msg[2] in match["players"]:
+      emit_to_player(match, "state_update", build_keyframe(match), msg[2])
+  elif kind == "spectate":
+    set_feed(msg[1], msg[2])
+
+def shard_reader(index, conn):
+  for msg in bus_messages(conn):
+    handle_shard_message(msg)
+  conn["closed"] = True
+  print(f"match shard {index} disconnected", file=sys.stderr)
+
+def start_match_shards(count):
+  path = BUS_PATH or f"/tmp/eclipse-bus-{os.getpid()}.sock"
+  if os.path.exists(path):
+    os.remove(path)
+  listener = eventlet.listen(path, family=socket.AF_UNIX)
+  BUS["listener"] = listener
+  env = dict(os.environ, MATCH_SHARDS="0")
+  BUS["procs"] = [
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), "--shard-worker", str(i), path], env=env)
+    for i in range(count)
+  ]
+  conns = [None] * count
+  for _ in range(count):
+    sock, _ = listener.accept()
+    conn = bus_connection(sock)
+    hello = next(bus_messages(conn))
+    conns[hello[1]] = conn
+  BUS["shards"] = conns
+  build_shard_ring(count)
+  BUS["role"] = "front"
+  for i, conn in enumerate(conns):
+    socketio.start_background_task(shard_reader, i, conn)
+
+def stop_match_shards():
+  for proc in BUS["procs"]:
+    proc.terminate()
+  for proc in BUS["procs"]:
+    proc.wait()
+  BUS["procs"] = []
+
+def run_shard_worker(index, path):
+  BUS["role"] = "worker"
+  sock = eventlet.connect(path, family=socket.AF_UNIX)
+  conn = bus_connection(sock)
+  BUS["front"] = conn
+  bus_send(conn, ("hello", index))
+  for msg in bus_messages(conn):
+    handle_front_message(msg)
+
+# ---------- BROADCAST FAN-OUT ----------
+
+# Global announcements never write to sockets from the caller. broadcast()
+# encodes the payload once and parks it under its event name; a newer
+# payload for the same event replaces one that has not gone out yet, or
+# cuts short a fan-out in progress, which then restarts with the newer
+# payload. A single green thread snapshots the connected sids and writes
+# for at most FANOUT_SLICE per hub iteration before yielding, so match
+# ticks and room emits are delayed by one slice at most.
+
+FANOUT_SLICE = 0.002  # seconds of socket writes per hub iteration
+FANOUT_BATCH = 64  # recipients between clock checks
+
+BROADCASTS = {
+    "pending": OrderedDict(),  # event -> engine.io packets of the newest payload
+    "generation": {},  # event -> bumped on every new payload
+    "task": None,
+    "delivered": 0,
+    "superseded": 0,
+}
+
+def broadcast(event, payload):
+  pkts = [eio_packet.Packet(eio_packet.MESSAGE, p) for p in encode_event(event, payload)]
+  pending = BROADCASTS["pending"]
+  generation = BROADCASTS["generation"]
+  if event in pending:
+    BROADCASTS["superseded"] += 1
+  pending[event] = pkts
+  generation[event] = generation.get(event, 0) + 1
+  if BROADCASTS["task"] is None:
+    BROADCASTS["task"] = socketio.start_background_task(fanout_loop)
+
+def fanout_loop():
+  pending = BROADCASTS["pending"]
+  try:
+    while pending:
+      event, pkts = pending.popitem(last=False)
+      fanout(event, pkts, BROADCASTS["generation"][event])
+  finally:
+    BROADCASTS["task"] = None
+
+def fanout(event, pkts, generation):
+  server = socketio.server
+  recipients = [eio_sid for _, eio_sid in server.manager.get_participants("/", None)]
+  perf_counter = time.perf_counter
+  i, n = 0, len(recipients)
+  while i < n:
+    if BROADCASTS["generation"][event] != generation:
+      BROADCASTS["superseded"] += 1
+      return
+    deadline = perf_counter() + FANOUT_SLICE
+    while i < n and perf_counter() < deadline:
+      for eio_sid in recipients[i:i + FANOUT_BATCH]:
+        for p in pkts:
+          server._send_eio_packet(eio_sid, p)
+      i += FANOUT_BATCH
+    socketio.sleep(0)
+  BROADCASTS["delivered"] += n
+
+# ---------- SPECTATORS ----------
+
+# Spectators of a match sit in its own room_id + "#spec" room, apart from
+# the player room, so nothing on the players' tick or emit path knows they
+# exist. Wherever the match runs (in-process or in a shard worker) a
+# separate green thread samples each watched match SPECTATE_RATE times a
+# second as a full keyframe. It encodes the keyframe once, holds it for
+# SPECTATE_DELAY seconds and writes the same packet to every spectator.
+# The front remembers the last packet per room so new spectators get a
+# picture straight away.
+
+SPECTATE_RATE = float(os.environ.get("SPECTATE_RATE", 4))  # snapshots per second
+SPECTATE_DELAY = float(os.environ.get("SPECTATE_DELAY", 0))  # seconds spectators trail the match
+SPECTATE_MAX_PER_ROOM = int(os.environ.get("SPECTATE_MAX_PER_ROOM", 2000))
+SPECTATE_ROOM_SUFFIX = "#spec"
+
+SPECTATORS = {}  # front/local: room_id -> set of spectator sids
+SPECTATOR_ROOM = {}  # front/local: sid -> room_id it watches
+SPECTATOR_LAST = {}  # front/local: room_id -> last encoded snapshot delivered
+SPECTATE = {
+    "feeds": {},  # match host: room_id -> {"queue": deque of (due, encoded), "seq", "done"}
+    "task": None,
+}
+
+def spectate_room(room_id):
+  return room_id + SPECTATE_ROOM_SUFFIX
+
+def room_is_live(room_id):
+  if BUS["role"] == "front":
+    info = ROOM_SHARD.get(room_id)
+    return bool(info) and not info["finished"]
+  match = MATCHES.get(room_id)
+  return bool(match) and not match["finished"]
+
+def start_spectating(sid, room_id):
+  stop_spectating(sid)
+  watchers = SPECTATORS.get(room_id)
+  if watchers is None:
+    watchers = SPECTATORS[room_id] = set()
+    route_feed(room_id, True)
+  elif len(watchers) >= SPECTATE_MAX_PER_ROOM:
+    return False
+  watchers.add(sid)
+  SPECTATOR_ROOM[sid] = room_id
+  socketio.server.enter_room(sid, spectate_room(room_id), namespace="/")
+  last = SPECTATOR_LAST.get(room_id)
+  if last is not None:
+    send_encoded(sid, last)
+  return True
+
+def stop_spectating(sid):
+  room_id = SPECTATOR_ROOM.pop(sid, None)
+  if room_id is None:
+    return
+  socketio.server.leave_room(sid, spectate_room(room_id), namespace="/")
+  watchers = SPECTATORS.get(room_id)
+  if watchers is not None:
+    watchers.discard(sid)
+    if not watchers:
+      del SPECTATORS[room_id]
+      SPECTATOR_LAST.pop(room_id, None)
+      route_feed(room_id, False)
+
+def release_spectators(room_id):
+  for sid in SPECTATORS.pop(room_id, ()):
+    SPECTATOR_ROOM.pop(sid, None)
+  SPECTATOR_LAST.pop(room_id, None)
+  socketio.server.close_room(spectate_room(room_id), namespace="/")
+
+def route_feed(room_id, on):
+  if BUS["role"] == "front":
+    info = ROOM_SHARD.get(room_id)
+    if info:
+      bus_send(BUS["shards"][info["shard"]], ("spectate", room_id, on))
+    return
+  set_feed(room_id, on)
+
+def set_feed(room_id, on):
+  # match host side
+  feeds = SPECTATE["feeds"]
+  if not on:
+    feeds.pop(room_id, None)
+    return
+  if room_id in feeds or room_id not in MATCHES:
+    return
+  feeds[room_id] = {"queue": deque(), "seq": None, "done": False}
+  if SPECTATE["task"] is None:
+    SPECTATE["task"] = socketio.start_background_task(spectate_loop)
+
+def deliver_spectators(room_id, encoded):
+  # front/local side
+  if room_id not in SPECTATORS:
+    return
+  SPECTATOR_LAST[room_id] = encoded
+  send_encoded(spectate_room(room_id), encoded)
+
+def spectate_loop():
+  feeds = SPECTATE["feeds"]
+  interval = 1.0 / SPECTATE_RATE
+  while feeds:
+    now = time.monotonic()
+    for room_id, feed in list(feeds.items()):
+      match = MATCHES.get(room_id)
+      if match is not None and not feed["done"] and match["seq"] != feed["seq"]:
+        feed["seq"] = match["seq"]
+        feed["done"] = match["finished"]
+        encoded = encode_event("spectator_update", build_keyframe(match))
+        feed["queue"].append((now + SPECTATE_DELAY, encoded))
+      queue = feed["queue"]
+      while queue and queue[0][0] <= now:
+        _, encoded = queue.popleft()
+        if BUS["role"] == "worker":
+          bus_send(BUS["front"], ("spectate_emit", room_id, encoded))
+        else:
+          deliver_spectators(room_id, encoded)
+      if not queue and (match is None or feed["done"]):
+        del feeds[room_id]
+    socketio.sleep(interval)
+  SPECTATE["task"] = None
+
+# ---------- WIRE FORMAT ----------
+
+# Clients may ask for MessagePack at connect time with auth {"wire": "msgpack"}.
+# match_start and state_update then arrive as a single binary argument:
+#   - known field names become small integer ids (WIRE_FIELDS index),
+#   - floats (positions, map geometry, all in 0..1) become round(v * WIRE_FLOAT_SCALE),
+#   - players are keyed by slot (order in the keyframe) instead of sid,
+#   - deltas drop room_id, which the client already has from match_start.
+# The "wire" event sent after connect carries the field table and scale.
+# Every other event stays JSON.
+
+WIRE_FIELDS = [
+    "type", "seq", "room_id", "players", "map", "active_pickups", "finished", "winning_team",
+    "user_id", "username", "fighter", "rarity", "hp", "max_hp", "damage", "speed", "team",
+    "eclipse_meter", "block_stamina", "blocking", "rounds_won", "is_me", "moving",
+    "screen_pos", "connected", "platforms", "hazards", "x", "y", "w", "h", "r",
+    "template", "seed",
+]
+WIRE_IDS = {name: i for i, name in enumerate(WIRE_FIELDS)}
+WIRE_FLOAT_SCALE = 10000
+WIRE_EVENTS = {"match_start", "state_update"}
+WIRE_ROOM_SUFFIX = "#bin"
+
+BINARY_SIDS = set()  # sids that negotiated msgpack
+
+def wire_room(room_id, sid):
+  return room_id + WIRE_ROOM_SUFFIX if sid in BINARY_SIDS else room_id
+
+def build_wire(players, binary):
+  if not binary:
+    return None
+  return {
+    "slots": {sid: i for i, sid in enumerate(players)},
+    "binary": set(binary),
+    "json": len(binary) < len(players),
+  }
+
+def wire_value(value):
+  kind = type(value)
+  if kind is float:
+    return round(value * WIRE_FLOAT_SCALE)
+  if kind is dict:
+    return {WIRE_IDS.get(k, k): wire_value(v) for k, v in value.items()}
+  if kind is list:
+    return [wire_value(v) for v in value]
+  return value
+
+def encode_wire(payload, slots):
+  out = {}
+  for k, v in payload.items():
+    if k == "players":
+      v = {slots.get(sid, sid): wire_value(p) for sid, p in v.items()}
+    elif k == "room_id" and payload["type"] == "delta":
+      continue
+    else:
+      v = wire_value(v)
+    out[WIRE_IDS.get(k, k)] = v
+  return msgpack.packb(out)
+
+def negotiate_wire(sid, auth):
+  requested = auth.get("wire") if isinstance(auth, dict) else None
+  if requested == "msgpack" and msgpack is not None:
+    BINARY_SIDS.add(sid)
+    emit("wire", {"format": "msgpack", "fields": WIRE_FIELDS, "float_scale": WIRE_FLOAT_SCALE})
+  elif requested:
+    emit("wire", {"format": "json"})
 
 # ---------- SOCKET.IO HANDLERS ----------
 
 @socketio.on("connect")
-def on_connect():
-  pass
+def on_connect(auth=None):
+  # Authenticate once; later events read the user bound to the sid.
+  token = auth.get("token") if isinstance(auth, dict) else None
+  user = get_user_from_token(token)
+  if user:
+    SID_USER[request.sid] = user["id"]
+  negotiate_wire(request.sid, auth)
 
 @socketio.on("disconnect")
 def on_disconnect():
-  pass
+  sid = request.sid
+  dequeue_player(sid)
+  room_id = SID_ROOM.pop(sid, None)
+  if room_id:
+    route_leave(room_id, sid)
+  SID_USER.pop(sid, None)
+  BINARY_SIDS.discard(sid)
+  SID_LIMITS.pop(sid, None)
+  stop_spectating(sid)
+
+def get_sid_user(sid):
+  user_id = SID_USER.get(sid)
+  if not user_id:
+    return None
+  return USERS.get(user_id)
 
 @socketio.on("queue_1v1")
 def on_queue_1v1():
-  token = request.headers.get("Authorization", "").replace("Bearer ", "")
-  user_id = TOKENS.get(token)
-  if not user_id:
-    return
-  user = USERS.get(user_id)
+  user = get_sid_user(request.sid)
   if not user:
     return
   queue_player(user, "1v1", request.sid)
 
 @socketio.on("queue_2v2")
 def on_queue_2v2():
-  token = request.headers.get("Authorization", "").replace("Bearer ", "")
-  user_id = TOKENS.get(token)
-  if not user_id:
-    return
-  user = USERS.get(user_id)
+  user = get_sid_user(request.sid)
   if not user:
     return
   queue_player(user, "2v2", request.sid)
 
+@socketio.on("queue_ffa")
+def on_queue_ffa():
+  user = get_sid_user(request.sid)
+  if not user:
+    return
+  queue_player(user, "ffa", request.sid)
+
 @socketio.on("action")
 def on_action(data):
-  room_ids = list(socketio.server.rooms(request.sid))
-  room_id = None
-  for r in room_ids:
-    if r != request.sid:
-      room_id = r
-      break
+  sid = request.sid
+  room_id = SID_ROOM.get(sid)
   if not room_id:
     return
-  action = data.get("action")
-  apply_action(room_id, request.sid, action)
+  action = data.get("action") if isinstance(data, dict) else None
+  pos = None
+  if action == "MOVE":
+    pos = parse_move(data)
+    if pos is None:
+      INPUT_DROPS["invalid"] += 1
+      return
+  if not allow_action(sid, action):
+    return
+  route_action(room_id, sid, action, pos)
+
+@socketio.on("resync")
+def on_resync():
+  room_id = SID_ROOM.get(request.sid)
+  if room_id:
+    route_resync(room_id, request.sid)
+
+@socketio.on("spectate")
+def on_spectate(data):
+  sid = request.sid
+  if not get_sid_user(sid) or sid_in_live_match(sid):
+    return
+  room_id = data.get("room_id") if isinstance(data, dict) else None
+  if not isinstance(room_id, str) or not room_is_live(room_id):
+    emit("spectate_error", {"room_id": room_id, "reason": "not_live"})
+    return
+  if not start_spectating(sid, room_id):
+    emit("spectate_error", {"room_id": room_id, "reason": "full"})
+
+@socketio.on("stop_spectating")
+def on_stop_spectating():
+  stop_spectating(request.sid)
+
+# ---------- METRICS ----------
+
+# Latency histograms use log-linear buckets (4 per power of two from 1us to
+# ~2 minutes), HDR-style: recording is one bisect and one list increment.
+# /metrics exports the power-of-two boundaries as Prometheus buckets.
+
+HIST_BOUNDS = [2 ** (e / 4) * 1e-6 for e in range(4 * 27 + 1)]
+HIST_EXPORT = list(range(0, len(HIST_BOUNDS), 4))
+HUB_LAG_INTERVAL = 0.1  # seconds between hub lag probes
+
+METRICS = {
+    "http": {},  # route -> histogram
+    "http_status": {},  # route -> {status: count}
+    "socket": {},  # event -> histogram
+    "emits": {},  # event -> [packets, bytes] as encoded by the Socket.IO server
+    "hub_lag": None,
+    "hub_monitor": None,
+}
+
+def new_histogram():
+  return [[0] * (len(HIST_BOUNDS) + 1), 0.0]
+
+def observe(hist, seconds):
+  hist[0][bisect.bisect_left(HIST_BOUNDS, seconds)] += 1
+  hist[1] += seconds
+
+METRICS["hub_lag"] = new_histogram()
+
+def count_emit(event, nbytes):
+  counts = METRICS["emits"].get(event)
+  if counts is None:
+    counts = METRICS["emits"][event] = [0, 0]
+  counts[0] += 1
+  counts[1] += nbytes
+
+class MetricsJSON:
+  # Socket.IO packet json module that counts encoded event bytes.
+
+  @staticmethod
+  def dumps(obj, *args, **kwargs):
+    encoded = json.dumps(obj, *args, **kwargs)
+    if type(obj) is list and obj and type(obj[0]) is str:
+      count_emit(obj[0], len(encoded))
+    return encoded
+
+  loads = staticmethod(json.loads)
+
+sio_packet.Packet.json = MetricsJSON
+
+# The wrappers inline observe() with everything bound locally; the added
+# cost per sample is two perf_counter() calls, a bisect and two increments.
+
+def timed_view(route, fn):
+  hist = METRICS["http"][route] = new_histogram()
+  statuses = METRICS["http_status"].setdefault(route, {})
+  counts, bounds, bisect_left, perf_counter = hist[0], HIST_BOUNDS, bisect.bisect_left, time.perf_counter
+
+  def wrapper(*args, **kwargs):
+    t0 = perf_counter()
+    try:
+      rv = fn(*args, **kwargs)
+    except Exception:
+      statuses[500] = statuses.get(500, 0) + 1
+      raise
+    finally:
+      elapsed = perf_counter() - t0
+      counts[bisect_left(bounds, elapsed)] += 1
+      hist[1] += elapsed
+    status = rv[1] if isinstance(rv, tuple) else getattr(rv, "status_code", 200)
+    statuses[status] = statuses.get(status, 0) + 1
+    return rv
+
+  wrapper.__name__ = fn.__name__
+  return wrapper
+
+def timed_handler(event, fn):
+  hist = METRICS["socket"][event] = new_histogram()
+  counts, bounds, bisect_left, perf_counter = hist[0], HIST_BOUNDS, bisect.bisect_left, time.perf_counter
+
+  def wrapper(*args):
+    t0 = perf_counter()
+    try:
+      return fn(*args)
+    finally:
+      elapsed = perf_counter() - t0
+      counts[bisect_left(bounds, elapsed)] += 1
+      hist[1] += elapsed
+
+  return wrapper
+
+def instrument_handlers():
+  for rule in app.url_map.iter_rules():
+    if rule.endpoint != "static":
+      app.view_functions[rule.endpoint] = timed_view(rule.rule, app.view_functions[rule.endpoint])
+  handlers = socketio.server.handlers.get("/", {})
+  for event, fn in list(handlers.items()):
+    handlers[event] = timed_handler(event, fn)
+
+def hub_monitor_loop():
+  # How late the hub wakes a sleeping green thread = time other green
+  # threads held the hub without yielding.
+  while True:
+    t0 = time.monotonic()
+    socketio.sleep(HUB_LAG_INTERVAL)
+    observe(METRICS["hub_lag"], max(0.0, time.monotonic() - t0 - HUB_LAG_INTERVAL))
+
+def ensure_hub_monitor():
+  if METRICS["hub_monitor"] is None:
+    METRICS["hub_monitor"] = socketio.start_background_task(hub_monitor_loop)
+
+def render_histogram(lines, name, labels, hist):
+  counts, total = hist
+  sep = "," if labels else ""
+  cumulative = 0
+  last = 0
+  for i in HIST_EXPORT:
+    cumulative += sum(counts[last:i + 1])
+    last = i + 1
+    lines.append(f'{name}_bucket{{{labels}{sep}le="{HIST_BOUNDS[i]:.9g}"}} {cumulative}')
+  cumulative += sum(counts[last:])
+  lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {cumulative}')
+  lines.append(f"{name}_sum{{{labels}}} {total:.9g}")
+  lines.append(f"{name}_count{{{labels}}} {cumulative}")
+
+def render_metrics():
+  lines = []
+  lines.append("# TYPE eclipse_http_request_duration_seconds histogram")
+  for route, hist in METRICS["http"].items():
+    render_histogram(lines, "eclipse_http_request_duration_seconds", f'route="{route}"', hist)
+  lines.append("# TYPE eclipse_http_responses_total counter")
+  for route, statuses in METRICS["http_status"].items():
+    for status, n in statuses.items():
+      lines.append(f'eclipse_http_responses_total{{route="{route}",status="{status}"}} {n}')
+  lines.append("# TYPE eclipse_socket_event_duration_seconds histogram")
+  for event, hist in METRICS["socket"].items():
+    render_histogram(lines, "eclipse_socket_event_duration_seconds", f'event="{event}"', hist)
+  lines.append("# TYPE eclipse_socket_emits_total counter")
+  lines.append("# TYPE eclipse_socket_emit_bytes_total counter")
+  for event, (packets, nbytes) in METRICS["emits"].items():
+    lines.append(f'eclipse_socket_emits_total{{event="{event}"}} {packets}')
+    lines.append(f'eclipse_socket_emit_bytes_total{{event="{event}"}} {nbytes}')
+  lines.append("# TYPE eclipse_input_dropped_total counter")
+  for reason, n in INPUT_DROPS.items():
+    lines.append(f'eclipse_input_dropped_total{{reason="{reason}"}} {n}')
+  lines.append("# TYPE eclipse_http_rate_limited_total counter")
+  for name, n in HTTP_DROPS.items():
+    lines.append(f'eclipse_http_rate_limited_total{{limit="{name}"}} {n}')
+  lines.append("# TYPE eclipse_match_results_total counter")
+  lines.append(f'eclipse_match_results_total{{outcome="applied"}} {RESULTS["applied"]}')
+  lines.append(f'eclipse_match_results_total{{outcome="duplicate"}} {RESULTS["duplicates"]}')
+  lines.append("# TYPE eclipse_cpu_pool_jobs_total counter")
+  lines.append(f'eclipse_cpu_pool_jobs_total{{outcome="completed"}} {CPU_POOL["completed"]}')
+  lines.append(f'eclipse_cpu_pool_jobs_total{{outcome="rejected"}} {CPU_POOL["rejected"]}')
+  lines.append("# TYPE eclipse_broadcast_deliveries_total counter")
+  lines.append(f"eclipse_broadcast_deliveries_total {BROADCASTS['delivered']}")
+  lines.append("# TYPE eclipse_broadcasts_superseded_total counter")
+  lines.append(f"eclipse_broadcasts_superseded_total {BROADCASTS['superseded']}")
+  lines.append("# TYPE eclipse_hub_lag_seconds histogram")
+  render_histogram(lines, "eclipse_hub_lag_seconds", "", METRICS["hub_lag"])
+  gauges = [
+    ("eclipse_users", "", len(USERS)),
+    ("eclipse_sessions", "", len(TOKENS)),
+    ("eclipse_matches", "", len(MATCHES)),
+    ("eclipse_sharded_rooms", "", len(ROOM_SHARD)),
+    ("eclipse_bound_sids", "", len(SID_USER)),
+    ("eclipse_pending_rooms", "", len(PENDING_ROOMS)),
+    ("eclipse_match_results_pending", "", len(RESULTS["queue"])),
+    ("eclipse_broadcasts_pending", "", len(BROADCASTS["pending"])),
+    ("eclipse_cpu_pool_inflight", "", CPU_POOL["inflight"]),
+    ("eclipse_spectators", "", len(SPECTATOR_ROOM)),
+    ("eclipse_spectator_feeds", "", len(SPECTATE["feeds"])),
+  ]
+  gauges += [("eclipse_queue_depth", f'mode="{mode}"', len(queue)) for mode, queue in MATCH_QUEUES.items()]
+  seen = set()
+  for name, labels, value in gauges:
+    if name not in seen:
+      lines.append(f"# TYPE {name} gauge")
+      seen.add(name)
+    lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+  return "\n".join(lines) + "\n"
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+  ensure_hub_monitor()
+  return app.response_class(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+instrument_handlers()
 
 # ---------- MAIN ----------
 
 if __name__ == "__main__":
-  CURRENT_EVENT = get_current_event()
+  if len(sys.argv) > 1 and sys.argv[1] == "--shard-worker":
+    run_shard_worker(int(sys.argv[2]), sys.argv[3])
+    sys.exit(0)
+  init_persistence()
+  ensure_hub_monitor()
+  if MATCH_SHARDS:
+    start_match_shards(MATCH_SHARDS)
+  ensure_event_scheduler()
   socketio.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
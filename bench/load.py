@@ -0,0 +1,220 @@
+"""In-process load generator for the HTTP routes and Socket.IO events.
+
+Simulated clients sign up, connect a socket, poll /me and the leaderboard
+routes, queue for matches and spam action events while in a match. All
+traffic goes through the Flask and Flask-SocketIO test clients inside one
+eventlet hub, so the numbers measure server-side handler cost (plus the
+test client's own packet decoding), not network time. With --shards the
+match simulation runs in real shard worker processes.
+
+  python bench/load.py --clients 200 --duration 30 --out run.json
+  python bench/load.py --compare before.json after.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import warnings
+
+warnings.filterwarnings("ignore")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import eventlet  # noqa: E402
+
+import app  # noqa: E402
+
+
+def percentile(sorted_values, q):
+  if not sorted_values:
+    return 0.0
+  return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def summarize(samples, duration):
+  values = sorted(samples)
+  return {
+    "count": len(values),
+    "rps": round(len(values) / duration, 2),
+    "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+    "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+    "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+    "max_ms": round(values[-1] * 1000, 3) if values else 0.0,
+  }
+
+
+class Recorder:
+  def __init__(self):
+    self.samples = {}  # name -> [seconds]
+    self.delivered = {}  # event -> [packets, bytes]
+    self.match_start_at = {}  # eio_sid -> perf_counter of the last match_start
+    self.first_update = []  # match_start -> first state_update, seconds
+
+  def timed(self, name, fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    result = fn(*args, **kwargs)
+    self.samples.setdefault(name, []).append(time.perf_counter() - t0)
+    return result
+
+  def install_probe(self):
+    # Timestamp every packet the server writes, keyed by recipient.
+    server = app.socketio.server
+    send = server._send_eio_packet
+
+    def probe(eio_sid, eio_pkt):
+      now = time.perf_counter()
+      data = eio_pkt.data
+      if isinstance(data, str) and data.startswith("2["):
+        event = data[3:data.find('"', 3)]
+        counts = self.delivered.setdefault(event, [0, 0])
+        counts[0] += 1
+        counts[1] += len(data)
+        if event == "match_start":
+          self.match_start_at[eio_sid] = now
+        elif event == "state_update":
+          started = self.match_start_at.pop(eio_sid, None)
+          if started is not None:
+            self.first_update.append(now - started)
+      send(eio_sid, eio_pkt)
+
+    server._send_eio_packet = probe
+
+
+def run_client(rec, http, sock, token, opts, deadline):
+  headers = {"Authorization": f"Bearer {token}"}
+  etag = None
+  queue_event = "queue_2v2" if opts.mode == "2v2" or (opts.mode == "mixed" and random.random() < 0.5) else "queue_1v1"
+  while time.monotonic() < deadline:
+    req_headers = dict(headers)
+    if etag:
+      req_headers["If-None-Match"] = etag
+    resp = rec.timed("GET /me", http.get, "/me", headers=req_headers)
+    etag = resp.headers.get("ETag")
+    rec.timed("GET /leaderboard/<stat>", http.get, "/leaderboard/wins", headers=headers)
+    rec.timed("GET /leaderboard/rank", http.get, "/leaderboard/rank?stat=wins", headers=headers)
+
+    rec.timed(queue_event, sock.emit, queue_event)
+    in_match = False
+    wait_until = time.monotonic() + opts.queue_timeout
+    while time.monotonic() < min(wait_until, deadline):
+      eventlet.sleep(0.05)
+      if any(m["name"] == "match_start" for m in sock.get_received()):
+        in_match = True
+        break
+    if not in_match:
+      continue
+
+    finished = False
+    while not finished and time.monotonic() < deadline:
+      rec.timed("action", sock.emit, "action", {"action": random.choice(opts.actions)})
+      eventlet.sleep(random.expovariate(opts.aps))
+      for m in sock.get_received():
+        if m["name"] == "state_update" and m["args"][0].get("finished"):
+          finished = True
+
+
+def run(opts):
+  if opts.shards:
+    app.start_match_shards(opts.shards)
+  app.MM_SWEEP_INTERVAL = opts.sweep_interval
+  # every simulated client shares one address, so lift the per-address limits
+  for name in app.HTTP_LIMITS:
+    app.HTTP_LIMITS[name] = (1e9, 1e9)
+  rec = Recorder()
+  tag = f"{os.getpid()}_{int(time.time())}"
+  clients = []
+  setup_start = time.monotonic()
+  for i in range(opts.clients):
+    http = app.app.test_client()
+    resp = rec.timed("POST /signup", http.post, "/signup", json={"username": f"load_{tag}_{i}", "password": "pw"})
+    token = resp.get_json()["token"]
+    sock = rec.timed("connect", app.socketio.test_client, app.app, auth={"token": token})
+    clients.append((http, sock, token))
+  setup_elapsed = time.monotonic() - setup_start
+  setup_names = list(rec.samples)
+  rec.install_probe()
+
+  start = time.monotonic()
+  deadline = start + opts.duration
+  threads = [eventlet.spawn(run_client, rec, http, sock, token, opts, deadline) for http, sock, token in clients]
+  for t in threads:
+    t.wait()
+  elapsed = time.monotonic() - start
+  for _, sock, _ in clients:
+    sock.disconnect()
+  if opts.shards:
+    app.stop_match_shards()
+
+  http_names = [n for n in rec.samples if n.startswith(("GET ", "POST "))]
+
+  def window(name):
+    return setup_elapsed if name in setup_names else elapsed
+
+  return {
+    "config": {
+      "clients": opts.clients,
+      "duration_s": opts.duration,
+      "mode": opts.mode,
+      "actions_per_sec": opts.aps,
+      "shards": opts.shards,
+      "tick_rate": app.TICK_RATE,
+      "cpus": os.cpu_count(),
+    },
+    "elapsed_s": round(elapsed, 3),
+    "http": {n: summarize(rec.samples[n], window(n)) for n in http_names},
+    "socket": {n: summarize(v, window(n)) for n, v in rec.samples.items() if n not in http_names},
+    "delivered": {e: {"packets": c[0], "bytes": c[1]} for e, c in rec.delivered.items()},
+    "match_start_to_first_state_update": summarize(rec.first_update, elapsed),
+  }
+
+
+def compare(before_path, after_path):
+  with open(before_path) as f:
+    before = json.load(f)
+  with open(after_path) as f:
+    after = json.load(f)
+  rows = {}
+  for group in ("http", "socket"):
+    for name, stats in after.get(group, {}).items():
+      old = before.get(group, {}).get(name)
+      if not old:
+        continue
+      rows[name] = {
+        k: {"before": old[k], "after": stats[k], "change_pct": round((stats[k] - old[k]) / old[k] * 100, 1) if old[k] else None}
+        for k in ("rps", "p50_ms", "p95_ms", "p99_ms")
+      }
+  return rows
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--clients", type=int, default=100)
+  parser.add_argument("--duration", type=float, default=20.0)
+  parser.add_argument("--mode", choices=["1v1", "2v2", "mixed"], default="mixed")
+  parser.add_argument("--aps", type=float, default=8.0, help="actions per second per client in a match")
+  parser.add_argument("--actions", nargs="+", default=["LIGHT_ATTACK", "HEAVY_ATTACK", "BLOCK", "ABILITY", "ECLIPSE"])
+  parser.add_argument("--queue-timeout", type=float, default=5.0)
+  parser.add_argument("--sweep-interval", type=float, default=0.25)
+  parser.add_argument("--shards", type=int, default=0, help="run match simulation in N worker processes")
+  parser.add_argument("--out", help="write the JSON report here instead of stdout")
+  parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+  opts = parser.parse_args()
+
+  if opts.compare:
+    print(json.dumps(compare(*opts.compare), indent=2))
+    return
+  if opts.shards and opts.shards + 1 > (os.cpu_count() or 1):
+    print(f"warning: {opts.shards} shards plus the front on {os.cpu_count()} CPUs; "
+          "throughput will not scale with --shards", file=sys.stderr)
+  report = run(opts)
+  text = json.dumps(report, indent=2)
+  if opts.out:
+    with open(opts.out, "w") as f:
+      f.write(text)
+  else:
+    print(text)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,115 @@
+"""Warm-restart benchmark for the persistence layer.
+
+Builds N synthetic users, writes a snapshot plus a WAL tail, then times
+load_state() in a fresh interpreter, as a real restart would. Prints one
+JSON object.
+
+  python bench/restart.py --users 1000000 --tail 100000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+
+def make_user(i):
+  return {
+    "id": f"bench-{i:08d}",
+    "username": f"bench_{i}",
+    "password": "x",
+    "coins": random.randint(0, 50000),
+    "gems": random.randint(0, 500),
+    "star_points": 0,
+    "owned_characters": {"fighter_1"},
+    "selected_character_id": "fighter_1",
+    "wins": random.randint(0, 500),
+    "damage": random.randint(0, 100000),
+    "kos": random.randint(0, 1000),
+    "event_xp": random.randint(0, 5000),
+    "bp_level": random.randint(1, 10),
+    "bp_xp": random.randint(0, 99),
+    "admin_events_created": 0,
+    "admin_events_triggered": 0,
+    "is_first_bogacactus": False,
+    "version": 1,
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--users", type=int, default=1000000)
+  parser.add_argument("--tail", type=int, default=100000, help="WAL records written after the snapshot")
+  parser.add_argument("--load", metavar="DIR", help="internal: time load_state() from DIR")
+  args = parser.parse_args()
+
+  if args.load:
+    app.DATA_DIR = args.load
+    t0 = time.perf_counter()
+    app.load_state()
+    print(json.dumps({
+      "load_s": time.perf_counter() - t0,
+      "users": len(app.USERS),
+      "top": app.LEADERBOARDS["wins"].slice(0, 75),
+    }))
+    return
+
+  app.DATA_DIR = tempfile.mkdtemp(prefix="eclipse-restart-")
+  app.open_wal_segment(1)
+  app.PERSIST["enabled"] = True
+
+  t0 = time.perf_counter()
+  for i in range(args.users):
+    user = make_user(i)
+    app.USERS[user["id"]] = user
+    app.USERNAME_INDEX[user["username"]] = user["id"]
+  for stat, field in app.LEADERBOARD_SOURCES.items():
+    if stat != "admin":
+      app.LEADERBOARDS[stat].load((u["id"], u[field]) for u in app.USERS.values())
+  build_s = time.perf_counter() - t0
+
+  t0 = time.perf_counter()
+  app.write_snapshot()
+  snapshot_s = time.perf_counter() - t0
+
+  t0 = time.perf_counter()
+  for _ in range(args.tail):
+    user = app.USERS[f"bench-{random.randrange(args.users):08d}"]
+    user["coins"] += 10
+    user["wins"] += 1
+    app.update_leaderboard("wins", user["id"], user["wins"])
+    app.persist_user(user, "coins", "wins")
+  app.commit_wal()
+  wal_s = time.perf_counter() - t0
+
+  app.PERSIST["wal"].close()
+  out = subprocess.run(
+    [sys.executable, os.path.abspath(__file__), "--load", app.DATA_DIR],
+    check=True, capture_output=True, text=True,
+  ).stdout
+  loaded = json.loads(out.strip().splitlines()[-1])
+  assert loaded["users"] == len(app.USERS)
+  assert [tuple(e) for e in loaded["top"]] == app.LEADERBOARDS["wins"].slice(0, 75)
+  load_s = loaded["load_s"]
+
+  sizes = {name: os.path.getsize(os.path.join(app.DATA_DIR, name)) for name in os.listdir(app.DATA_DIR)}
+  print(json.dumps({
+    "users": args.users,
+    "wal_tail_records": args.tail,
+    "build_s": round(build_s, 3),
+    "snapshot_write_s": round(snapshot_s, 3),
+    "wal_append_commit_s": round(wal_s, 3),
+    "restart_load_s": round(load_s, 3),
+    "files": sizes,
+  }))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,110 @@
+"""JSON vs MessagePack wire encoding for match_start and state_update.
+
+Plays random actions through real matches and captures every state
+payload the server would emit, then encodes each one both ways exactly as
+emit_to_room does: the Socket.IO JSON packet, and encode_wire() plus the
+binary Socket.IO packet. Reports encode time per emit and bytes per emit.
+
+  python bench/wire.py --matches 200 --ticks 200 --mode 2v2
+"""
+import os
+import sys
+import copy
+import json
+import time
+import random
+import argparse
+import warnings
+
+warnings.filterwarnings("ignore")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+from socketio import packet as sio_packet  # noqa: E402
+
+ACTIONS = ["LIGHT_ATTACK", "HEAVY_ATTACK", "BLOCK", "ABILITY", "ECLIPSE"]
+
+
+def capture(opts):
+  # Route emits into a list instead of the socket server. Keyframes hold the
+  # live player dicts, so keep a copy.
+  emitted = []
+  app.emit_to_room = lambda event, payload, room, wire=None: emitted.append((event, copy.deepcopy(payload)))
+  size = 4 if opts.mode == "2v2" else 2
+  samples = []
+  for m in range(opts.matches):
+    players = {}
+    for i in range(size):
+      user = {"id": f"bench-{m}-{i}", "username": f"bench_{m}_{i}", "selected_character_id": f"fighter_{i % 5 + 1}"}
+      players[f"sid-{m}-{i:02d}-xxxxxxxxxxxx"] = app.build_player_state(user, team=1 + i % 2)
+    room_id = f"room-{m}"
+    match = app.create_match(room_id, players, list(players))
+    app.emit_match_start(match)
+    for _ in range(opts.ticks):
+      for sid in players:
+        if random.random() < opts.action_rate:
+          app.queue_action(room_id, sid, random.choice(ACTIONS))
+      app.run_match_tick(match)
+      if match["finished"]:
+        break
+    samples.extend((event, payload, match["wire"]["slots"]) for event, payload in emitted)
+    emitted.clear()
+    app.MATCHES.pop(room_id, None)
+  return samples
+
+
+def packet_size(encoded):
+  encoded = encoded if isinstance(encoded, list) else [encoded]
+  return sum(len(p) for p in encoded)
+
+
+def measure(samples, encode, repeat):
+  sizes = {}
+  best = None
+  for _ in range(repeat):
+    t0 = time.perf_counter()
+    for event, payload, slots in samples:
+      encode(event, payload, slots)
+    elapsed = time.perf_counter() - t0
+    best = elapsed if best is None else min(best, elapsed)
+  for event, payload, slots in samples:
+    sizes.setdefault(event, []).append(packet_size(encode(event, payload, slots)))
+  return {
+    "encode_us_per_emit": round(best / len(samples) * 1e6, 3),
+    "bytes_per_emit": {e: round(sum(v) / len(v), 1) for e, v in sizes.items()},
+  }
+
+
+def encode_json(event, payload, slots):
+  return app.socketio.server.packet_class(sio_packet.EVENT, namespace="/", data=[event, payload]).encode()
+
+
+def encode_msgpack(event, payload, slots):
+  data = app.encode_wire(payload, slots)
+  return app.socketio.server.packet_class(sio_packet.EVENT, namespace="/", data=[event, data]).encode()
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--matches", type=int, default=200)
+  parser.add_argument("--ticks", type=int, default=200)
+  parser.add_argument("--mode", choices=["1v1", "2v2"], default="2v2")
+  parser.add_argument("--action-rate", type=float, default=0.4, help="chance each player acts on a tick")
+  parser.add_argument("--repeat", type=int, default=5)
+  opts = parser.parse_args()
+  if app.msgpack is None:
+    sys.exit("msgpack is not installed")
+
+  random.seed(1)
+  samples = capture(opts)
+  report = {
+    "config": vars(opts),
+    "emits": len(samples),
+    "json": measure(samples, encode_json, opts.repeat),
+    "msgpack": measure(samples, encode_msgpack, opts.repeat),
+  }
+  print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+  main()